@@ -0,0 +1,727 @@
+#!/usr/bin/env python3
+
+import csv
+import glob
+import json
+import sys
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from os import path, chdir, environ, getcwd, mkdir
+from random import Random
+
+# The benchmarks run headless, no window is opened
+environ.setdefault("SDL_VIDEODRIVER", "dummy")
+environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+from two_wiimotes import Constants, GestureRecognizer, ActivityRecognizer, TemplateLoader, Pointing, Tracking, \
+    MovingAverageFilter, OneEuroFilter, WiimoteRecorder, WiimoteReplay, ReplayedWiimote, WiimoteGame, Enemy, \
+    BackgroundCompositor, Assets
+
+"""
+Benchmarks for the hot paths of two_wiimotes.py. They use synthetic input, so no Wiimote is needed.
+
+Usage: python3 benchmark.py [name of benchmark ...] [--output results.json] [--compare baseline.json]
+If no name is passed, all benchmarks are run. The results can be written to a JSON file and compared with the results
+of another version, e.g. python3 benchmark.py hot_paths --output new.json --compare old.json
+"""
+
+RESULTS = {}  # Results of all measurements by name, written to the file passed with --output
+
+
+# Calls the function repeatedly and returns the durations of the calls in milliseconds
+def measure(function, repetitions):
+    durations = []
+    for i in range(repetitions):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return np.array(durations)
+
+
+# Runs the function with tracemalloc and returns the bytes allocated at the peak of a call and the bytes that are
+# still allocated after a call, as medians over the calls. tracemalloc slows down the calls, so this is not done
+# together with measuring the durations
+def measure_allocations(function, repetitions):
+    tracemalloc.start()
+    peaks = []
+    retained = []
+    for i in range(repetitions):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained.append(current - before)
+    tracemalloc.stop()
+    return np.median(peaks), np.median(retained)
+
+
+# Prints the durations (and allocations) of a measurement and stores them in RESULTS
+def print_result(name, durations, allocations=None):
+    result = {"p50_ms": float(np.percentile(durations, 50)), "p99_ms": float(np.percentile(durations, 99)),
+              "mean_ms": float(np.mean(durations)), "max_ms": float(np.max(durations)), "calls": len(durations)}
+    line = "{:<60} p50: {:8.3f} ms   p99: {:8.3f} ms   max: {:8.3f} ms".format(
+        name, result["p50_ms"], result["p99_ms"], result["max_ms"])
+    if allocations is not None:
+        result["alloc_peak_bytes"], result["retained_bytes"] = float(allocations[0]), float(allocations[1])
+        line += "   alloc: {:8.0f} B   retained: {:6.0f} B".format(*allocations)
+    RESULTS[name] = result
+    print(line)
+
+
+# Creates the cursor coordinates of a square drawn by the player, like they are collected in on_wiimote_a_pressed
+def synthetic_square(num_points, seed=0):
+    random = Random(seed)
+    corners = [(0, 0), (300, 0), (300, 300), (0, 300), (0, 0)]
+    x_values = []
+    y_values = []
+    for i in range(num_points):
+        side = i * 4 // num_points
+        t = (i * 4 / num_points) - side
+        start = corners[side]
+        end = corners[side + 1]
+        x_values.append(500 + start[0] + (end[0] - start[0]) * t + random.uniform(-3, 3))
+        y_values.append(300 + start[1] + (end[1] - start[1]) * t + random.uniform(-3, 3))
+    return x_values, y_values
+
+
+# Adds rotated copies of the shipped templates until the recognizer has the given number of templates
+def add_synthetic_templates(recognizer, num_templates):
+    i = 0
+    while len(recognizer.gestures) < num_templates:
+        template = recognizer.gestures[i % 2]
+        rotated = recognizer.translate(recognizer.rotateBy(template, 0.05 * (i + 1)))
+        recognizer.add_template("synthetic_" + str(i), rotated)
+        i += 1
+
+
+# Latency of the recognition that is done in check_wiimote_input after the A button has been released
+def benchmark_gesture_recognizer():
+    for num_templates in [2, 32, 128]:
+        for num_points in [50, 200, 800]:
+            x_values, y_values = synthetic_square(num_points)
+            for method in GestureRecognizer.METHODS:
+                recognizer = GestureRecognizer(method)
+                add_synthetic_templates(recognizer, num_templates)
+                durations = measure(lambda: recognizer.recognize_drawing(list(x_values), list(y_values)), 30)
+                print_result("recognize_drawing {} ({} points, {} templates)".format(method, num_points,
+                                                                                    num_templates), durations)
+
+    # Preprocessing of long strokes (e.g. a slowly drawn barricade at 60 Hz)
+    recognizer = GestureRecognizer()
+    for num_points in [200, 1000, 5000]:
+        x_values, y_values = synthetic_square(num_points)
+        points = np.column_stack((x_values, y_values))
+        print_result("resample ({} points)".format(num_points), measure(lambda: recognizer.resample(points), 30))
+
+
+# Drawings that should be recognized: the shipped templates, rotated, distorted, with noise and drawn with a different
+# number of points
+def positive_drawings(recognizer, count, random):
+    drawings = []
+    for i in range(count):
+        template = np.array(recognizer.gestures[i % len(recognizer.gestures)])
+        angle = random.uniform(-0.5, 0.5)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        points = (template - 100) @ rotation.T * [random.uniform(1, 3), random.uniform(1, 3)] + 400
+        num_points = random.randint(30, 300)
+        positions = np.linspace(0, len(points) - 1, num_points)
+        x_values = np.interp(positions, np.arange(len(points)), points[:, 0])
+        y_values = np.interp(positions, np.arange(len(points)), points[:, 1])
+        noise = [random.uniform(-4, 4) for j in range(2 * num_points)]
+        drawings.append((list(x_values + noise[:num_points]), list(y_values + noise[num_points:])))
+    return drawings
+
+
+# Drawings that should not be recognized: circles, triangles, lines, zigzags and random scribbles
+def negative_drawings(count, random):
+    drawings = []
+    for i in range(count):
+        num_points = random.randint(30, 300)
+        t = np.linspace(0, 1, num_points)
+        shape = i % 5
+        if shape == 0:
+            x_values, y_values = 400 + 150 * np.cos(2 * np.pi * t), 400 + 150 * np.sin(2 * np.pi * t)
+        elif shape == 1:
+            corners = np.array([[0, 0], [300, 0], [150, 260], [0, 0]])
+            x_values = np.interp(t * 3, np.arange(4), corners[:, 0]) + 300
+            y_values = np.interp(t * 3, np.arange(4), corners[:, 1]) + 300
+        elif shape == 2:
+            x_values, y_values = 300 + 400 * t, 300 + 100 * t
+        elif shape == 3:
+            x_values, y_values = 300 + 400 * t, 300 + 80 * np.abs(((t * 8) % 2) - 1)
+        else:
+            x_values = 400 + np.cumsum([random.uniform(-20, 20) for j in range(num_points)])
+            y_values = 400 + np.cumsum([random.uniform(-20, 20) for j in range(num_points)])
+        drawings.append((list(x_values), list(y_values)))
+    return drawings
+
+
+# Accuracy and latency of the different matching methods on the shipped drawing templates
+def benchmark_gesture_accuracy():
+    random = Random(1)
+    positives = positive_drawings(GestureRecognizer(), 100, random)
+    negatives = negative_drawings(100, random)
+
+    for method in GestureRecognizer.METHODS:
+        recognizer = GestureRecognizer(method)
+        recognized = [recognizer.recognize_drawing(x, y) for x, y in positives]
+        rejected = [not recognizer.recognize_drawing(x, y) for x, y in negatives]
+        points = [recognizer.preprocess(np.column_stack(drawing)) for drawing in positives]
+        durations = measure(lambda: [recognizer.get_best_match(p) for p in points], 10) / len(points)
+        print_result("get_best_match {} (recognized: {}%, rejected: {}%)".format(
+            method, sum(recognized) * 100 // len(recognized), sum(rejected) * 100 // len(rejected)), durations)
+
+
+# Creates a stream of accelerometer values like the Wiimote would deliver it (one value per frame) by concatenating
+# the recorded activity templates. Returns the values and the (start, end) of each reload in the stream.
+def recorded_activity_stream():
+    stands = sorted(glob.glob(path.join("activity_templates", "stand_*.csv")))
+    reloads = sorted(glob.glob(path.join("activity_templates", "reload_*.csv")))
+    values = []
+    reload_segments = []
+    for i in range(len(stands)):
+        values.extend(np.loadtxt(stands[i], delimiter=",").tolist())
+        if i < len(reloads):
+            start = len(values)
+            values.extend(np.loadtxt(reloads[i], delimiter=",").tolist())
+            reload_segments.append((start, len(values)))
+    return values, reload_segments
+
+
+# Feeds the stream to predict_activity and returns the hit rate of the reloads, the latencies of the detections (in
+# frames), the number of false detections and the duration of predict_activity per call in milliseconds
+def detect_reloads(recognizer, values, reload_segments):
+    detections = []
+    start = time.perf_counter()
+    for i in range(len(values)):
+        if recognizer.predict_activity(*values[i]) == "reload":
+            detections.append(i)
+    duration = (time.perf_counter() - start) * 1000 / len(values)
+
+    latencies = []
+    for segment_start, segment_end in reload_segments:
+        # A detection counts if it happens while the reload is in the window
+        hits = [i for i in detections if segment_start <= i < segment_end + recognizer.minlen]
+        if len(hits) > 0:
+            latencies.append(hits[0] - segment_start)
+    false_detections = [i for i in detections
+                        if not any(start <= i < end + recognizer.minlen for start, end in reload_segments)]
+    return len(latencies) * 100 // len(reload_segments), latencies, len(false_detections), duration
+
+
+# Detection latency and hit rate of the reload gesture depending on the hop size of the sliding window.
+# The classifier is trained on the same recordings, so the hit rate is optimistic.
+def benchmark_activity_hop_size():
+    values, reload_segments = recorded_activity_stream()
+    window_size = ActivityRecognizer().minlen
+    # A hop size of the window size means that the windows do not overlap
+    for hop_size in [1, 5, 10, 20, 40, window_size]:
+        recognizer = ActivityRecognizer(hop_size)
+        hit_rate, latencies, false_detections, duration = detect_reloads(recognizer, values, reload_segments)
+        print("hop size {:3d}: hit rate {:3d}%   latency {:6.1f} frames   false detections {:3d}   "
+              "predict_activity {:.3f} ms per call".format(hop_size, hit_rate,
+                                                           np.mean(latencies) if latencies else np.nan,
+                                                           false_detections, duration))
+    print("memory used by the accelerometer buffer: {} bytes".format(recognizer.get_stats()["buffer_memory_bytes"]))
+
+
+# Trains with all recordings but one and classifies every window of the left out recording. Returns the share of
+# correctly classified windows and the mean margin of the windows (positive if classified correctly, only for
+# classifiers with a decision_function)
+def leave_one_out(features, classifier_name="rbf_svm"):
+    recognizer = ActivityRecognizer(cache_file=False, features=features, classifier=classifier_name)
+    names, values, offsets = TemplateLoader.load("activity_templates", 3)
+    recordings = [values[offsets[i]:offsets[i + 1]].T for i in range(len(names))]
+    labels = np.array([name.split("_")[0] for name in names])
+    window_size = min(recording.shape[1] for recording in recordings)
+
+    correct = []
+    margins = []
+    for i in range(len(recordings)):
+        others = [j for j in range(len(recordings)) if j != i]
+        extractor = ActivityRecognizer.FEATURES[features]()
+        classifier = recognizer.create_classifier(classifier_name)
+        classifier.fit(extractor.fit_transform(np.array([recordings[j][:, :window_size] for j in others])),
+                       labels[others])
+        windows = np.array([recordings[i][:, start:start + window_size]
+                            for start in range(recordings[i].shape[1] - window_size + 1)])
+        windows_features = extractor.transform(windows)
+        correct.extend(classifier.predict(windows_features) == labels[i])
+        if hasattr(classifier, "decision_function"):
+            # decision_function is positive for the second class (classes_ is sorted)
+            sign = 1 if labels[i] == classifier.classes_[1] else -1
+            margins.extend(sign * classifier.decision_function(windows_features))
+    return np.mean(correct) * 100, np.mean(margins) if margins else np.nan
+
+
+# Training time, prediction time and separation of reload and stand for the different features
+def benchmark_activity_features():
+    values, reload_segments = recorded_activity_stream()
+    ActivityRecognizer(cache_file=False)  # sklearn is imported by the first recognizer
+    for features in ActivityRecognizer.FEATURES:
+        training = measure(lambda: ActivityRecognizer(cache_file=False, features=features), 5)
+        recognizer = ActivityRecognizer(cache_file=False, features=features)
+        window = np.array(values[:recognizer.minlen], dtype=float).T[np.newaxis]
+        extraction = measure(lambda: recognizer.feature_extractor.transform(window), 200)
+        prediction = measure(lambda: recognizer.c.predict(recognizer.feature_extractor.transform(window)), 200)
+        accuracy, margin = leave_one_out(features)
+        hit_rate, latencies, false_detections, duration = detect_reloads(ActivityRecognizer(
+            1, cache_file=False, features=features), values, reload_segments)
+        print("{} ({} features per window)".format(features, recognizer.features.shape[1]))
+        print_result("    training (read templates, extract features, fit)", training)
+        print_result("    feature extraction of one window", extraction)
+        print_result("    feature extraction and prediction of one window", prediction)
+        print("    leave one out: {:.1f}% of the windows correct, mean margin {:.2f}".format(accuracy, margin))
+        print("    stream (hop size 1): hit rate {}%, false detections {}, latency {:.1f} frames".format(
+            hit_rate, false_detections, np.mean(latencies) if latencies else np.nan))
+
+
+# Startup time of the ActivityRecognizer without cache (training), with a valid cache and without caching at all
+def benchmark_activity_startup():
+    with tempfile.TemporaryDirectory() as directory:
+        cache_file = path.join(directory, "activity_model.pickle")
+        print_result("ActivityRecognizer cold start (trains and writes the cache)",
+                     measure(lambda: ActivityRecognizer(cache_file=cache_file), 1))
+        print_result("ActivityRecognizer warm start (loads the cache)",
+                     measure(lambda: ActivityRecognizer(cache_file=cache_file), 10))
+        print_result("ActivityRecognizer without cache", measure(lambda: ActivityRecognizer(cache_file=False), 3))
+        print("size of the cache file: {} bytes".format(path.getsize(cache_file)))
+
+
+# Writes copies of the shipped templates with some noise, so there are num_templates files in each template directory
+def write_template_corpus(directory, num_templates, random):
+    for template_directory, integer_values in [("activity_templates", True), ("drawing_templates", False)]:
+        mkdir(path.join(directory, template_directory))
+        shipped = sorted(glob.glob(path.join(template_directory, "*.csv")))
+        for i in range(num_templates):
+            values = np.loadtxt(shipped[i % len(shipped)], delimiter=",")
+            values = values + [random.uniform(-2, 2) for j in range(values.shape[1])]
+            name = path.splitext(path.basename(shipped[i % len(shipped)]))[0].split("_")[0] + "_" + str(i) + ".csv"
+            np.savetxt(path.join(directory, template_directory, name), values, delimiter=",",
+                       fmt="%d" if integer_values else "%.15g")
+
+
+# The per-line parsing the recognizers used before the TemplateLoader, for comparison
+def load_per_line(directory):
+    templates = []
+    for csv_file in glob.glob(path.join(directory, "*.csv")):
+        with open(csv_file) as file:
+            templates.append([[float(value) for value in row] for row in csv.reader(file, delimiter=",")])
+    return templates
+
+
+# Startup time of the recognizers for template corpora grown to thousands of recorded templates
+def benchmark_template_loading():
+    game_directory = getcwd()
+    for num_templates in [10, 1000, 5000]:
+        with tempfile.TemporaryDirectory() as directory:
+            write_template_corpus(directory, num_templates, Random(2))
+            chdir(directory)
+            for template_directory, num_columns in [("activity_templates", 3), ("drawing_templates", 2)]:
+                print_result("per line parsing of {} ({} files)".format(template_directory, num_templates),
+                             measure(lambda: load_per_line(template_directory), 3))
+                print_result("TemplateLoader.load of {} ({} files)".format(template_directory, num_templates),
+                             measure(lambda: TemplateLoader.load(template_directory, num_columns), 3))
+            print_result("ActivityRecognizer startup without cache ({} templates)".format(num_templates),
+                         measure(lambda: ActivityRecognizer(cache_file=False), 1))
+            print_result("GestureRecognizer startup ({} templates)".format(num_templates),
+                         measure(lambda: GestureRecognizer(), 1))
+            chdir(game_directory)
+
+
+# Fit time, predict latency and accuracy of the classifiers for the reload detection, for all features
+def benchmark_activity_classifiers():
+    values, reload_segments = recorded_activity_stream()
+    for features in ActivityRecognizer.FEATURES:
+        for classifier in ActivityRecognizer.CLASSIFIERS:
+            recognizer = ActivityRecognizer(cache_file=False, features=features, classifier=classifier)
+            labels = recognizer.labels
+            fit = measure(lambda: recognizer.create_classifier(classifier).fit(recognizer.features, labels), 20)
+            window = recognizer.feature_extractor.transform(
+                np.array(values[:recognizer.minlen], dtype=float).T[np.newaxis])
+            predict = measure(lambda: recognizer.c.predict(window), 500)
+            accuracy, margin = leave_one_out(features, classifier)
+            hit_rate, latencies, false_detections, duration = detect_reloads(ActivityRecognizer(
+                1, cache_file=False, features=features, classifier=classifier), values, reload_segments)
+            print("{} with {}: leave one out {:.1f}% correct, stream hit rate {}%, false detections {}".format(
+                classifier, features, accuracy, hit_rate, false_detections))
+            print_result("    fit", fit)
+            print_result("    predict one window", predict)
+
+
+# Four LEDs around the center of the IR camera, like the pointing Wiimote sees the frame of the screen
+def synthetic_led_samples(count, random):
+    samples = []
+    for i in range(count):
+        center_x, center_y = random.uniform(300, 700), random.uniform(250, 500)
+        half_width, half_height = random.uniform(150, 300), random.uniform(100, 200)
+        corners = [(-1, -1), (-1, 1), (1, 1), (1, -1)]
+        leds = [(int(center_x + dx * half_width + random.uniform(-30, 30)),
+                 int(center_y + dy * half_height + random.uniform(-30, 30))) for dx, dy in corners]
+        random.shuffle(leds)
+        samples.append(leds)
+    return samples
+
+
+# The transformation like it was calculated before for every sample (steps 1 to 7 of the notebook "Projective
+# Transformations"), with the sorting of Pointing.map_to_screen, for comparing the results and the duration
+def map_to_screen_per_sample(leds, width, height):
+    points = sorted(leds, key=lambda k: k[0])
+    A, B = (points[0], points[1]) if points[0][1] < points[1][1] else (points[1], points[0])
+    D, C = (points[2], points[3]) if points[2][1] < points[3][1] else (points[3], points[2])
+
+    def unit_to(a, b, c, d):
+        l, m, t = np.linalg.solve(np.array([[a[0], b[0], c[0]], [a[1], b[1], c[1]], [1, 1, 1]]), [d[0], d[1], 1])
+        return np.array([[l * a[0], m * b[0], t * c[0]], [l * a[1], m * b[1], t * c[1]], [l, m, t]])
+
+    source_to_dest = unit_to((0, height), (0, 0), (width, 0), (width, height)) @ np.linalg.inv(unit_to(A, B, C, D))
+    x, y, z = source_to_dest @ [Constants.WIIMOTE_IR_CAM_CENTER[0], Constants.WIIMOTE_IR_CAM_CENTER[1], 1]
+    return int(x / z), int(y / z)
+
+
+# Per-sample cost of Pointing.process_ir_data, which runs for every IR sample of the pointing Wiimote
+def benchmark_pointing():
+    samples = synthetic_led_samples(1000, Random(3))
+    width, height = 1920, 1080
+    pointing = Pointing(width, height)
+    results = [pointing.process_ir_data(*leds) for leds in samples]
+    expected = [map_to_screen_per_sample(leds, width, height) for leds in samples]
+    # The results can differ by one pixel, because of rounding errors before the conversion to int
+    differences = np.abs(np.array(results) - np.array(expected)).max()
+    print("largest difference to the per-sample matrix solution: {} pixel".format(differences))
+
+    print_result("matrix solution per sample (1000 samples)",
+                 measure(lambda: [map_to_screen_per_sample(leds, width, height) for leds in samples], 10))
+    print_result("Pointing.process_ir_data (1000 samples)",
+                 measure(lambda: [pointing.process_ir_data(*leds) for leds in samples], 10))
+    print("Pointing.get_stats: {}".format(pointing.get_stats()))
+
+
+# The cursor positions calculated by Pointing at 100 Hz: the cursor is held still, moved quickly to another position and
+# held still again. Returns the timestamps, the positions without noise and the noisy positions
+def synthetic_pointer_path(random):
+    timestamps = np.arange(0, 2.1, 0.01)
+    progress = np.clip((timestamps - 1) / 0.1, 0, 1)
+    true_positions = np.column_stack((500 + 800 * progress, 400 + 300 * progress))
+    noise = np.array([[random.gauss(0, 4), random.gauss(0, 4)] for i in range(len(timestamps))])
+    return timestamps, true_positions, np.round(true_positions + noise)
+
+
+# How the cursor was filtered before: the mean of batches of five samples, the cursor does not move in between
+class BatchAverageFilter:
+
+    def __init__(self, size):
+        self.size = size
+        self.x_values = []
+        self.y_values = []
+        self.position = None
+
+    def filter(self, x, y, timestamp):
+        self.x_values.append(x)
+        self.y_values.append(y)
+        if len(self.x_values) == self.size:
+            self.position = sum(self.x_values) / self.size, sum(self.y_values) / self.size
+            self.x_values = []
+            self.y_values = []
+        return self.position
+
+
+# Jitter while the cursor is held still, lag while it is moved and cost per sample of the cursor filters
+def benchmark_pointer_filter():
+    timestamps, true_positions, positions = synthetic_pointer_path(Random(4))
+    samples = [(x, y, timestamp) for (x, y), timestamp in zip(positions.tolist(), timestamps.tolist())]
+    still = (timestamps > 0.5) & (timestamps < 1)
+    moving = (timestamps >= 1) & (timestamps < 1.3)
+    filters = [("5 sample batches (before)", lambda: BatchAverageFilter(Constants.MOVING_AVERAGE_NUM_VALUES)),
+               ("sliding moving average", lambda: MovingAverageFilter(Constants.MOVING_AVERAGE_NUM_VALUES)),
+               ("One Euro", lambda: OneEuroFilter(Constants.ONE_EURO_MIN_CUTOFF, Constants.ONE_EURO_BETA))]
+    for name, create_filter in filters:
+        cursor_filter = create_filter()
+        cursor = [cursor_filter.filter(*sample) for sample in samples]
+        cursor = np.array([position if position is not None else (np.nan, np.nan) for position in cursor])
+        errors = np.hypot(*(cursor - true_positions).T)
+        updates = np.count_nonzero(np.any(np.diff(cursor, axis=0) != 0, axis=1))
+        print("{:<30} jitter {:5.2f} px   lag while moving {:6.1f} px   cursor updates {:3d} of {} samples".format(
+            name, np.nanstd(cursor[still], axis=0).mean(), np.nanmean(errors[moving]), updates, len(samples)))
+        cursor_filter = create_filter()
+        durations = measure(lambda: [cursor_filter.filter(*sample) for sample in samples], 50) / len(samples)
+        print("    filter: {:.2f} us per sample".format(np.median(durations) * 1000))
+
+
+# Records a synthetic session of the given length (in frames at 60 FPS) with two Wiimotes. The pointing Wiimote sends
+# two IR samples per frame, the head tracking Wiimote one. The timestamps are the ones of a session at 60 FPS
+def record_synthetic_session(filename, num_frames, random):
+    frame = [0]
+    recorder = WiimoteRecorder(filename, clock=lambda: frame[0] / 60)
+    connect = recorder.wrap_connect(lambda address, name: ReplayedWiimote())
+    tracker = connect("tracker", None)
+    pointer = connect("pointer", None)
+    tracker.ir.register_callback(lambda ir_data: None)
+    pointer.ir.register_callback(lambda ir_data: None)
+    samples = synthetic_led_samples(num_frames, random)
+
+    start = time.perf_counter()
+    for i in range(num_frames):
+        for j in range(2):
+            pointer.wiimote.ir.callback([{"x": x, "y": y} for x, y in samples[i]])
+        tracker.wiimote.ir.callback([{"x": 400 + i % 100, "y": 300}, {"x": 500 + i % 100, "y": 300}])
+        pointer.wiimote.buttons["A"] = i % 120 < 30
+        pointer.wiimote.accelerometer = (random.randint(400, 600), random.randint(400, 600), random.randint(500, 700))
+        recorder.record_states()
+        frame[0] += 1
+    recorder.close()
+    return (time.perf_counter() - start) * 1000 / recorder.num_records
+
+
+# Cost of recording and replaying the data of the Wiimotes
+def benchmark_replay():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = path.join(directory, "session.wiimote")
+        num_frames = 60 * 60
+        record_duration = record_synthetic_session(filename, num_frames, Random(5))
+        replay = WiimoteReplay(filename)
+        print("recorded {} frames: {} records, {} bytes, {:.2f} us per record".format(
+            num_frames, len(replay.records), path.getsize(filename), record_duration * 1000))
+
+        def replay_all():
+            replay = WiimoteReplay(filename)
+            for device in replay.devices:
+                replay.connect(None).ir.register_callback(lambda ir_data: None)
+            while replay.advance(1 / 60):
+                pass
+        print_result("replay of {} records with advance(1 / 60)".format(len(replay.records)), measure(replay_all, 5))
+
+
+# The LED positions of the head tracking Wiimote at 60 FPS: the head is held still, moved slowly to one side, held
+# still, moved quickly back and held still again. The positions have the noise of the IR camera
+def synthetic_head_path(random):
+    centers = np.concatenate((np.full(120, 512.0), np.linspace(512, 812, 180), np.full(120, 812.0),
+                              np.linspace(812, 512, 30), np.full(150, 512.0)))
+    return [((x - 50 + random.gauss(0, 1), 384 + random.gauss(0, 1)), (x + 50 + random.gauss(0, 1),
+                                                                      384 + random.gauss(0, 1)))
+            for x in centers]
+
+
+# Cost per frame and cache hits of the parallax background while the head is tracked, compared with drawing the three
+# layers directly every frame
+def benchmark_background():
+    Constants.init_display(headless=True)
+    tracking = Tracking()
+    positions = [tracking.process_ir_data_two_leds(*leds) for leds in synthetic_head_path(Random(7))]
+    screen = Constants.SCREEN
+
+    def draw_directly():
+        compositor = BackgroundCompositor(1)
+        for player_x, player_y in positions:
+            BackgroundCompositor.draw_layers(screen, compositor.get_offsets(player_x, player_y))
+    print_result("background: three layers directly ({} frames)".format(len(positions)), measure(draw_directly, 5))
+
+    for offset_step in [1, 4, 8]:
+        def draw_composed():
+            compositor = BackgroundCompositor(offset_step)
+            for player_x, player_y in positions:
+                offsets = compositor.get_offsets(player_x, player_y)
+                background = compositor.get_background(offsets)
+                if background is None:
+                    BackgroundCompositor.draw_layers(screen, offsets)
+                else:
+                    screen.blit(background, (0, 0))
+            return compositor
+        print_result("background: BackgroundCompositor, step {} px ({} frames)".format(offset_step, len(positions)),
+                     measure(draw_composed, 5))
+        stats = draw_composed().get_stats()
+        print("    hit rate {:.0%}: {}".format(stats["hits"] / len(positions), stats))
+
+
+# The game without the endless loop. It is played with a replayed recording, one frame per iteration, and the frame
+# rate is not limited. The background music is not part of the repository, so it is not loaded
+class BenchmarkGame(WiimoteGame):
+
+    def __init__(self, recording):
+        super().__init__(replay_file=recording, replay_per_frame=True)
+
+    def init_sounds(self):
+        self.sounds = {name: pygame.mixer.Sound(path.join("sounds", name + ".wav"))
+                       for name in ["shot", "reload", "ouch", "no_ammo", "game_over"]}
+
+    def play_music(self):
+        pass
+
+    def stop_music(self):
+        pass
+
+    def start_loop(self):
+        self.reset_game()
+        self.clock = UnlimitedClock()
+
+    # Places the given number of enemies on the screen. They are spread over the screen, so they do not reach the
+    # player at the same time
+    def set_enemies(self, num_enemies, random):
+        for enemy in list(self.enemies):
+            self.enemies.remove(enemy)
+        for i in range(num_enemies):
+            x, y = random.randint(0, Constants.WIDTH - 200), random.randint(0, Constants.HEIGHT - 200)
+            self.enemies.add(Enemy(1, x, y, 1, random.randint(1, 4)))
+
+    # One iteration with the same number of enemies: no new enemies are added and the game is never over
+    def loop_iteration(self):
+        self.level_seconds_counter = 0
+        self.lives = Constants.MAX_NUM_LIVES
+        super().loop_iteration()
+
+
+class UnlimitedClock:
+
+    def __init__(self):
+        self.clock = pygame.time.Clock()
+
+    def tick(self, framerate=0):
+        return self.clock.tick()
+
+
+# Calls the function with the next element of the inputs on every call
+def cycle(function, inputs):
+    iterator = iter(())
+
+    def call():
+        nonlocal iterator
+        try:
+            value = next(iterator)
+        except StopIteration:
+            iterator = iter(inputs)
+            value = next(iterator)
+        function(*value)
+    return call
+
+
+# Latency and allocations of the functions that run every frame or for every sample of a Wiimote
+def benchmark_hot_paths():
+    random = Random(6)
+    repetitions = 2000
+
+    def run(name, function, repetitions=repetitions):
+        function()  # Caches are filled by the first call
+        print_result(name, measure(function, repetitions), measure_allocations(function, min(repetitions, 500)))
+
+    pointing = Pointing(1920, 1080)
+    run("Pointing.process_ir_data", cycle(pointing.process_ir_data, synthetic_led_samples(500, random)))
+
+    tracking = Tracking()
+    heads = [((random.randint(300, 500), random.randint(300, 500)),
+              (random.randint(500, 700), random.randint(300, 500)))
+             for i in range(500)]
+    run("Tracking.process_ir_data_two_leds", cycle(tracking.process_ir_data_two_leds, heads))
+
+    gesture_recognizer = GestureRecognizer()
+    drawings = [synthetic_square(100, seed) for seed in range(20)] + negative_drawings(20, random)
+    run("GestureRecognizer.recognize_drawing", cycle(gesture_recognizer.recognize_drawing, drawings), 200)
+
+    activity_recognizer = ActivityRecognizer()
+    values, reload_segments = recorded_activity_stream()
+    run("ActivityRecognizer.predict_activity", cycle(activity_recognizer.predict_activity, values))
+
+    with tempfile.TemporaryDirectory() as directory:
+        recording = path.join(directory, "session.wiimote")
+        record_synthetic_session(recording, 60 * 60, random)
+        game = BenchmarkGame(recording)
+
+        # Spawning an enemy only looks up the shared images. After each of the four enemy images has been loaded once,
+        # the misses of the image registry must not grow
+        for number in range(1, 5):
+            Enemy(1, 100, 100, 1, number)
+        misses = Assets.get_stats()["misses"]
+        run("Enemy spawn", lambda: Enemy(1, 100, 100, 1, random.randint(1, 4)))
+        print("    Assets: {}, new misses while spawning: {}".format(Assets.get_stats(),
+                                                                   Assets.get_stats()["misses"] - misses))
+
+        for num_enemies in [1, 10, 50]:
+            game.set_enemies(num_enemies, random)
+            run("WiimoteGame.check_enemy_behind ({} enemies)".format(num_enemies), game.check_enemy_behind)
+            run("WiimoteGame.loop_iteration ({} enemies)".format(num_enemies), game.loop_iteration, 300)
+
+        # The HUD lines are only rebuilt when the score, the munition or the lives change
+        print("    HUD rebuilds and skips: info line {}, munition line {}".format(game.info_line.get_stats(),
+                                                                              game.munition_line.get_stats()))
+
+        # Overhead of the frame profiler and its overlay
+        game.profiler.toggle()
+        run("WiimoteGame.loop_iteration (50 enemies, profiler enabled)", game.loop_iteration, 300)
+        game.profiler.toggle()
+
+
+BENCHMARKS = {
+    "gesture": benchmark_gesture_recognizer,
+    "gesture_accuracy": benchmark_gesture_accuracy,
+    "activity_hop_size": benchmark_activity_hop_size,
+    "activity_startup": benchmark_activity_startup,
+    "activity_features": benchmark_activity_features,
+    "activity_classifiers": benchmark_activity_classifiers,
+    "pointing": benchmark_pointing,
+    "pointer_filter": benchmark_pointer_filter,
+    "replay": benchmark_replay,
+    "background": benchmark_background,
+    "hot_paths": benchmark_hot_paths,
+    "template_loading": benchmark_template_loading,
+}
+
+
+# Prints the measurements that got slower than in the baseline by more than the threshold (e.g. 0.2 for 20 %).
+# Returns the number of regressions
+def compare_results(baseline, threshold):
+    regressions = 0
+    for name, result in RESULTS.items():
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]
+        change = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] > 0 else 0.0
+        marker = ""
+        if change > threshold:
+            marker = "   REGRESSION"
+            regressions += 1
+        print("{:<60} p50: {:8.3f} ms -> {:8.3f} ms ({:+6.1f} %){}".format(name, old["p50_ms"], result["p50_ms"],
+                                                                          change * 100, marker))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for two_wiimotes.py")
+    parser.add_argument("names", nargs="*", help="benchmarks to run: " + ", ".join(BENCHMARKS.keys()))
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown of the p50 latency that counts as regression (default: 0.2)")
+    arguments = parser.parse_args()
+
+    # Read before changing the directory, so relative paths work
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+    output = path.abspath(arguments.output) if arguments.output else None
+
+    # The templates are loaded relative to the directory of the game
+    chdir(path.dirname(path.abspath(__file__)))
+
+    names = arguments.names or list(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: " + name + ". Available: " + ", ".join(BENCHMARKS.keys()))
+            sys.exit(1)
+        BENCHMARKS[name]()
+
+    if output:
+        with open(output, "w") as file:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "pygame": pygame.version.ver,
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": RESULTS}, file, indent=2)
+    if baseline is not None and compare_results(baseline, arguments.threshold) > 0:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,19 @@
 import glob
 import sys
 import pygame
-import wiimote
 import math
 import time
 import csv
+import json
+import pickle
+import hashlib
+import threading
 import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
-from scipy import fft
-from sklearn import svm
-from os import path
+from numpy.fft import rfft
+from os import path, environ, makedirs
 
 """
 Sources:
@@ -35,8 +39,23 @@ Sources:
 """
 
 
-# Pygame needs to be initialized at the beginning
-pygame.init()
+"""
+The constants that depend on the display (the screen object and its resolution) are only created when they are
+accessed for the first time. This way, the module can be imported without opening a window, e.g. to use the
+GestureRecognizer, the ActivityRecognizer or the Pointing class in tools or benchmarks.
+"""
+
+
+class LazyDisplayConstants(type):
+
+    DISPLAY_CONSTANTS = ["SCREEN", "WIDTH", "HEIGHT", "MAX_BARRICADE_WIDTH", "MAX_BARRICADE_HEIGHT"]
+
+    # Only called if the attribute does not exist yet. Opens the display on the first access of a display constant
+    def __getattr__(cls, name):
+        if name in LazyDisplayConstants.DISPLAY_CONSTANTS:
+            cls.init_display()
+            return type.__getattribute__(cls, name)
+        raise AttributeError("type object 'Constants' has no attribute '" + name + "'")
 
 
 """
@@ -44,7 +63,7 @@ For easy access to constants from all classes, they have been put into their own
 """
 
 
-class Constants:
+class Constants(metaclass=LazyDisplayConstants):
     WIIMOTE_TRACKER_ADDRESS = "B8:AE:6E:55:B5:0F"  # MAC Address of the "Tracker" Wiimote
     WIIMOTE_POINTER_ADDRESS = "B8:AE:6E:1B:5B:03"  # MAC Address of the "Pointer" Wiimote
 
@@ -59,6 +78,10 @@ class Constants:
     DURATION_BETWEEN_ENEMIES = 150  # Steps between enemy spawns
     CROSSHAIR_SIZE = 100  # Size in pixel of the Crosshair
     MOVING_AVERAGE_NUM_VALUES = 5  # num of values that should be buffered for moving average filter
+    POINTER_FILTER = "moving_average"  # Filter for the cursor position: "moving_average" or "one_euro"
+    ONE_EURO_MIN_CUTOFF = 1.0  # Cutoff frequency of the One Euro filter if the cursor does not move (in Hz)
+    ONE_EURO_BETA = 0.007  # Increase of the cutoff frequency with the speed of the cursor (in Hz per pixel/s)
+    IR_SAMPLE_QUEUE_SIZE = 64  # IR samples of a Wiimote that are buffered until the next frame, newer ones are dropped
 
     # The tracking of the head needs to be inverted if the tracking wiimote is behind and not in front of the player
     INVERT_HEAD_TRACKING_LEFT_RIGHT = True
@@ -76,53 +99,935 @@ class Constants:
     BARRICADE_COLOR = (251, 197, 49)  # Color of the barricade
     HINT_COLOR = (251, 197, 49)  # Text Color of displaying hints
 
-    SCREEN = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)  # The pygame screen object
-    WIDTH = pygame.display.get_surface().get_width()  # Horizontal resolution of the display
-    HEIGHT = pygame.display.get_surface().get_height()  # Vertical resolution of the display
+    # Only redraw and update the changed areas of the screen instead of flipping the whole screen every frame
+    DIRTY_RECT_RENDERING = False
+
+    # In the headless mode, the SDL dummy video driver is used instead of opening a fullscreen window
+    HEADLESS = environ.get("SDL_VIDEODRIVER") == "dummy"
+    HEADLESS_RESOLUTION = (1920, 1080)  # Resolution of the screen in the headless mode
+
+    # The data of the Wiimotes can be recorded to a file while playing and the game can be played with a recording
+    # instead of connected Wiimotes (see WiimoteRecorder and WiimoteReplay)
+    WIIMOTE_RECORDING_FILE = environ.get("WIIMOTE_RECORDING_FILE")
+    WIIMOTE_REPLAY_FILE = environ.get("WIIMOTE_REPLAY_FILE")
+    WIIMOTE_REPLAY_SPEED = 1.0  # 1.0 replays the recording like it was recorded, None as fast as possible
+    # Instead of replaying in real time, every iteration of the game loop replays the next 1 / FPS sec of the recording.
+    # This makes runs deterministic, e.g. for benchmarks
+    WIIMOTE_REPLAY_PER_FRAME = False
+
+    # The duration of each stage of the game loop is measured while the profiler is enabled. The key toggles the
+    # profiler and its overlay. The histograms of the durations are written to the file when the game is closed
+    PROFILER_ENABLED = False
+    PROFILER_KEY = pygame.K_F3
+    PROFILER_EXPORT_FILE = "frame_profile.json"
+
+    # SCREEN, WIDTH, HEIGHT, MAX_BARRICADE_WIDTH and MAX_BARRICADE_HEIGHT are set by init_display()
 
-    MAX_BARRICADE_WIDTH = WIDTH/2  # Max width of a barricade a user can draw
-    MAX_BARRICADE_HEIGHT = HEIGHT/2  # Max hight of a barricade a user can draw
+    BACKGROUND_OFFSET_STEP = 4  # The background layers are only moved in steps of this size (in pixel)
+
+    # Method for matching drawings with the templates: "dollar_one", "vectorized" or "protractor"
+    GESTURE_RECOGNITION_METHOD = "vectorized"
+
+    # Number of new accelerometer values between two predictions of the activity (the windows overlap)
+    ACTIVITY_HOP_SIZE = 10
+
+    # Features the activity is classified with: "band_energy" or "mean_spectrum"
+    ACTIVITY_FEATURES = "band_energy"
+
+    # Classifier for the activity: "rbf_svm", "linear_svm" or "nearest_centroid"
+    ACTIVITY_CLASSIFIER = "rbf_svm"
 
     # Letters allowed for entering a name for the highscore
     NAME_INPUT_LETTERS = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R",
                           "S", "T", "U", "V", "W", "X", "Y", "Z", "1", "2", "3", "4", "5", "6", "7", "8", "9", "0", "_"]
 
     IMG_DIR = path.join(path.dirname(__file__), 'img')  # defines the directory where all images are located
+    CACHE_DIR = 'cache'  # directory for data that is computed at the first start, next to the template directories
+
+    # Initializes pygame and opens the display. Gets called automatically on the first access of a display constant.
+    # If headless is True, the SDL dummy video driver is used, so no window is opened.
+    @classmethod
+    def init_display(cls, headless=None):
+        if "SCREEN" in cls.__dict__:  # The display has already been opened
+            return cls.SCREEN
+
+        if headless is not None:
+            cls.HEADLESS = headless
+        if cls.HEADLESS:
+            environ["SDL_VIDEODRIVER"] = "dummy"
+            environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+        pygame.init()
+        if cls.HEADLESS:
+            cls.SCREEN = pygame.display.set_mode(cls.HEADLESS_RESOLUTION)  # The pygame screen object
+        else:
+            cls.SCREEN = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+        cls.WIDTH = cls.SCREEN.get_width()  # Horizontal resolution of the display
+        cls.HEIGHT = cls.SCREEN.get_height()  # Vertical resolution of the display
 
-    # Images used in the game:
-    GAME_BACKGROUND_LAYER_1 = \
-        pygame.transform.scale(pygame.image.load(path.join(IMG_DIR, "parallax-forest-back-trees.png")),
-                               (WIDTH, HEIGHT)).convert()
-    GAME_BACKGROUND_LAYER_2 = \
-        pygame.transform.scale(pygame.image.load(path.join(IMG_DIR, "parallax-forest-middle-trees.png")),
-                               (WIDTH + 100, HEIGHT)).convert_alpha()
-    GAME_BACKGROUND_LAYER_3 = \
-        pygame.transform.scale(pygame.image.load(path.join(IMG_DIR, "parallax-forest-front-trees.png")),
-                               (WIDTH + 100, HEIGHT)).convert_alpha()
-    CROSSHAIR_IMAGE = pygame.image.load(path.join(IMG_DIR, "circle-5.png")).convert()
-    BULLET_HOLE_IMAGE = pygame.image.load(path.join(IMG_DIR, "bullet_hole.png")).convert_alpha()
-    BULLET_IMAGE = pygame.image.load(path.join(IMG_DIR, "bullet.png"))
-    HEART_IMAGE = pygame.image.load(path.join(IMG_DIR, "heart.png"))
+        cls.MAX_BARRICADE_WIDTH = cls.WIDTH/2  # Max width of a barricade a user can draw
+        cls.MAX_BARRICADE_HEIGHT = cls.HEIGHT/2  # Max hight of a barricade a user can draw
+        return cls.SCREEN
 
 
-class WiimoteGame:
+"""
+This class is a process wide registry for the images of the game objects. Every image is decoded, scaled and
+colorkeyed only once and is then shared by reference between all objects that use it (e.g. every Enemy).
+The hit and miss counters show how often an image could be taken from the cache and how often it had to be loaded.
+"""
+
+
+class Assets:
+
+    EXPLOSION_SIZE = 90  # Size of the frames of the explosion animation in pixel
+    NUM_EXPLOSION_FRAMES = 16  # Number of images of the explosion animation
+    NUM_ENEMY_IMAGES = 5  # Number of different enemy images
+
+    cache = {}  # All loaded images. Key is a tuple of (filename, size, colorkey, alpha)
+    animations = {}  # All prepared animations (AnimationStrip objects), key is the name of the animation
+    hits = 0  # Number of requests that have been answered from the cache
+    misses = 0  # Number of requests that needed to load the image from the disk
+
+    # Returns the requested image. If it has not been requested before, it gets loaded from the image folder,
+    # scaled to the given size and colorkeyed. Afterwards it is kept in the cache.
+    @classmethod
+    def get_image(cls, filename, size=None, colorkey=None, alpha=False):
+        key = (filename, size, colorkey, alpha)
+        if key in cls.cache:
+            cls.hits += 1
+            return cls.cache[key]
+
+        cls.misses += 1
+        image = pygame.image.load(path.join(Constants.IMG_DIR, filename))
+        if size is not None:
+            image = pygame.transform.scale(image, size)
+        if alpha:
+            image = image.convert_alpha()
+        else:
+            image = image.convert()
+        if colorkey is not None:
+            image.set_colorkey(colorkey)
+
+        cls.cache[key] = image
+        return image
+
+    # The image of an enemy (1.png - 5.png), scaled to the size of the enemies
+    @classmethod
+    def get_enemy_image(cls, number):
+        return cls.get_image(str(number) + ".png", (Constants.ENEMY_SIZE, Constants.ENEMY_SIZE), (0, 0, 0))
+
+    # The explosion animation. The frames are scaled, colorkeyed and packed into one atlas only once
+    @classmethod
+    def get_explosion_animation(cls):
+        key = "explosion"
+        if key in cls.animations:
+            cls.hits += 1
+            return cls.animations[key]
+
+        cls.misses += 1
+        size = (cls.EXPLOSION_SIZE, cls.EXPLOSION_SIZE)
+        frames = [cls.get_image("explosion_" + str(i) + ".png", size) for i in range(1, cls.NUM_EXPLOSION_FRAMES + 1)]
+        animation = AnimationStrip(frames, size, (0, 0, 0))
+        cls.animations[key] = animation
+        return animation
+
+    # The three layers of the parallax background. The tree layers are wider than the screen, so they can be moved
+    @classmethod
+    def get_background_layers(cls):
+        tree_layer_size = (Constants.WIDTH + 100, Constants.HEIGHT)
+        return [cls.get_image("parallax-forest-back-trees.png", (Constants.WIDTH, Constants.HEIGHT)),
+                cls.get_image("parallax-forest-middle-trees.png", tree_layer_size, alpha=True),
+                cls.get_image("parallax-forest-front-trees.png", tree_layer_size, alpha=True)]
+
+    @classmethod
+    def get_bullet_hole_image(cls):
+        return cls.get_image("bullet_hole.png", alpha=True)
+
+    @classmethod
+    def get_crosshair_image(cls):
+        return cls.get_image("circle-5.png", (Constants.CROSSHAIR_SIZE, Constants.CROSSHAIR_SIZE), (0, 0, 0))
+
+    @classmethod
+    def get_bullet_image(cls):
+        return cls.get_image("bullet.png", alpha=True)
+
+    @classmethod
+    def get_heart_image(cls):
+        return cls.get_image("heart.png", alpha=True)
+
+    # Returns the hit and miss counters and the number of cached images
+    @classmethod
+    def get_stats(cls):
+        return {"hits": cls.hits, "misses": cls.misses, "cached_images": len(cls.cache),
+                "cached_animations": len(cls.animations)}
+
+
+"""
+This class holds the frames of an animation. The frames are packed side by side into one atlas surface when the
+animation is created and colorkeyed once. Each frame is a subsurface view into that atlas, so playing the animation
+only costs one blit per frame instead of scaling an image on every tick.
+"""
+
+
+class AnimationStrip:
+
+    def __init__(self, frames, size, colorkey=None):
+        self.size = size
+        self.atlas = pygame.Surface((size[0] * len(frames), size[1])).convert()
+
+        for i in range(len(frames)):
+            self.atlas.blit(frames[i], (i * size[0], 0))
+
+        # The colorkey has to be set before the subsurfaces are created, so that every frame inherits it
+        if colorkey is not None:
+            self.atlas.set_colorkey(colorkey)
+
+        self.frames = [self.atlas.subsurface((i * size[0], 0, size[0], size[1])) for i in range(len(frames))]
+
+    # Returns the frame with the given index
+    def get_frame(self, index):
+        return self.frames[index]
+
+    def __len__(self):
+        return len(self.frames)
+
+
+"""
+This class caches rendered text. Font objects are shared for each font size and every rendered string is kept in a
+least recently used cache, keyed by (font size, text, color, background). Text that did not change since the last
+frame is only blitted from the cache and not rendered again.
+"""
+
+
+class TextCache:
+
+    MAX_ENTRIES = 256  # Max number of rendered strings kept in the cache
+
+    fonts = {}  # Shared font objects, key is the font size
+    cache = OrderedDict()  # Rendered text surfaces, the least recently used entry is the first one
+    hits = 0  # Number of strings that have been taken from the cache
+    misses = 0  # Number of strings that needed to be rendered
+
+    # Returns the shared font object for the given size
+    @classmethod
+    def get_font(cls, size):
+        if size not in cls.fonts:
+            cls.fonts[size] = pygame.font.Font(None, size)
+        return cls.fonts[size]
+
+    # Returns the rendered text. It only gets rendered if it is not in the cache yet.
+    @classmethod
+    def render(cls, text, size, color, background=None):
+        key = (size, text, color, background)
+        if key in cls.cache:
+            cls.hits += 1
+            cls.cache.move_to_end(key)
+            return cls.cache[key]
+
+        cls.misses += 1
+        if background is None:
+            surface = cls.get_font(size).render(text, 1, color)
+        else:
+            surface = cls.get_font(size).render(text, 1, color, background)
+
+        cls.cache[key] = surface
+        if len(cls.cache) > cls.MAX_ENTRIES:  # Evict the least recently used entry
+            cls.cache.popitem(last=False)
+        return surface
+
+    # Returns the hit and miss counters and the number of cached strings
+    @classmethod
+    def get_stats(cls):
+        return {"hits": cls.hits, "misses": cls.misses, "cached_texts": len(cls.cache)}
+
+
+"""
+This class brings the drawn frame onto the display. In the dirty rectangle mode, only the regions of the screen that
+changed are recomposed and updated instead of flipping the whole screen every frame. Every drawn element reports its
+rect to the renderer. In the next frame, the background is only restored within these rects and only they are passed
+to pygame.display.update(). If the background itself changes (e.g. the parallax layers moved), the whole screen is
+redrawn.
+"""
+
+
+class Renderer:
+
+    def __init__(self, dirty_rects):
+        self.dirty_rects = dirty_rects  # If False, the whole screen is drawn and flipped every frame
+        self.rects = []  # Areas that have been drawn in the current frame
+        self.previous_rects = []  # Areas that have been drawn in the last frame
+        self.full_redraw = True  # Flag: The whole screen needs to be redrawn in the current frame
+        self.background_state = None  # Describes the background that is currently on the screen
+
+    # The whole screen has to be redrawn and updated in the current frame
+    def invalidate(self):
+        self.full_redraw = True
+
+    # Remember the area of an element that has been drawn in the current frame
+    def add(self, rect):
+        if self.dirty_rects and rect:
+            self.rects.append(rect)
+
+    # Remember the areas of all sprites of a group that has been drawn in the current frame
+    def add_sprites(self, group):
+        if self.dirty_rects:
+            self.rects.extend([sprite.rect.copy() for sprite in group])
+
+    # Draws the background using the passed function. In the dirty rectangle mode, the background is only restored
+    # where elements have been drawn in the last frame, as long as the background state did not change
+    def draw_background(self, state, draw_function):
+        if not self.dirty_rects or self.full_redraw or state != self.background_state:
+            self.background_state = state
+            self.full_redraw = True
+            draw_function()
+            return
+
+        for rect in self.previous_rects:
+            Constants.SCREEN.set_clip(rect)
+            draw_function()
+        Constants.SCREEN.set_clip(None)
+
+    # Update the display, either completely or only the changed areas of the last and the current frame
+    def present(self):
+        if not self.dirty_rects or self.full_redraw:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.previous_rects + self.rects)
+
+        self.previous_rects = self.rects
+        self.rects = []
+        self.full_redraw = False
+
+
+"""
+This class is a HUD element (e.g. the info line or the munition line). It keeps a pre-composited surface that is only
+rebuilt when the displayed value changes. In all other frames the cached surface is just blitted onto the screen.
+The counters show how often the surface had to be rebuilt and how often rebuilding could be skipped.
+"""
+
+
+class HudWidget:
+
+    def __init__(self, pos, size, build_function):
+        self.pos = pos
+        self.surface = pygame.Surface(size).convert()
+        self.build_function = build_function  # Draws a value onto the surface, gets called with (surface, value)
+        self.value = None  # The value that is currently displayed
+        self.changed = False  # Flag: The surface has been rebuilt in the last call of draw()
+        self.rebuilds = 0
+        self.skips = 0
+
+    # Draws the widget onto the screen and returns the rect it covers. The surface is only rebuilt if the value changed.
+    def draw(self, value):
+        if self.rebuilds == 0 or value != self.value:
+            self.value = value
+            self.build_function(self.surface, value)
+            self.rebuilds += 1
+            self.changed = True
+        else:
+            self.skips += 1
+            self.changed = False
+        return Constants.SCREEN.blit(self.surface, self.pos)
+
+    def get_stats(self):
+        return {"rebuilds": self.rebuilds, "skips": self.skips}
+
+
+"""
+This class composes the parallax background. The three layers are merged into one opaque surface for each
+(quantized) offset of the tree layers. The merged surfaces of the most recently used offsets are kept in a small
+cache, so a frame in which the head barely moved only costs one opaque blit instead of two alpha blends. While the
+offsets keep changing from frame to frame, nothing is merged and the layers are drawn directly, because a merged
+surface that is only used once costs an additional full screen blit.
+"""
+
+
+class BackgroundCompositor:
+
+    CACHE_MEMORY = 64 * 1024 * 1024  # Memory for the merged backgrounds (in bytes), each needs WIDTH * HEIGHT * 4
+
+    def __init__(self, offset_step=4):
+        self.offset_step = offset_step  # The offsets of the layers are rounded to multiples of this value (in pixel)
+        self.cache_size = max(2, min(8, self.CACHE_MEMORY // (Constants.WIDTH * Constants.HEIGHT * 4)))
+        self.cache = OrderedDict()  # Merged backgrounds, key is the pair of layer offsets
+        self.last_offsets = None  # Offsets of the previous frame
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    # Calculates the quantized positions of the two tree layers, depending on the position of the head
+    def get_offsets(self, player_x, player_y):
+        step = self.offset_step
+        layer_2_pos = (int(-(player_x - Constants.WIDTH/2)/100 - 50) // step * step,
+                       int(-(player_y - Constants.HEIGHT/2)/100) // step * step)
+        layer_3_pos = (int(-(player_x - Constants.WIDTH/2)/50 - 50) // step * step,
+                       int(-(player_y - Constants.HEIGHT/2)/50) // step * step)
+        return layer_2_pos, layer_3_pos
+
+    # Returns the merged background for the given offsets. It is only composed if it is not in the cache and the
+    # offsets are the same as in the previous frame. Otherwise, None is returned and the layers have to be drawn with
+    # draw_layers()
+    def get_background(self, offsets):
+        if offsets in self.cache:
+            self.hits += 1
+            self.last_offsets = offsets
+            self.cache.move_to_end(offsets)
+            return self.cache[offsets]
+
+        if offsets != self.last_offsets:  # The head is moving, the merged background would probably not be reused
+            self.bypasses += 1
+            self.last_offsets = offsets
+            return None
+
+        self.misses += 1
+        if len(self.cache) >= self.cache_size:  # Reuse the surface of the least recently used background
+            background = self.cache.popitem(last=False)[1]
+        else:
+            background = pygame.Surface((Constants.WIDTH, Constants.HEIGHT)).convert()
+
+        self.draw_layers(background, offsets)
+        self.cache[offsets] = background
+        return background
+
+    # Draws the three layers with the given offsets onto the surface
+    @staticmethod
+    def draw_layers(surface, offsets):
+        layer_1, layer_2, layer_3 = Assets.get_background_layers()
+        layer_2_pos, layer_3_pos = offsets
+        surface.blit(layer_1, (0, 0))
+        surface.blit(layer_2, layer_2_pos)
+        surface.blit(layer_3, layer_3_pos)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bypasses": self.bypasses,
+                "cached_backgrounds": len(self.cache)}
+
+
+"""
+This class is a bounded ring queue for the samples of a Wiimote. The callback thread of the wiimote library pushes the
+raw samples with a timestamp, the game loop takes all of them once per frame. There is exactly one producer and one
+consumer: the producer only changes write_index and the consumer only read_index, and a slot is written before
+write_index is increased. So no lock is needed. If the game loop does not keep up, new samples are dropped.
+"""
+
+
+class SampleQueue:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = [None] * capacity  # Pairs of (timestamp, sample)
+        self.write_index = 0  # Number of samples pushed so far, only changed by the producer
+        self.read_index = 0  # Number of samples taken so far, only changed by the consumer
+        self.dropped = 0  # Samples that were dropped because the queue was full
+        self.max_depth = 0  # Largest number of samples that were waiting when the consumer took them
+        self.time_of_latencies = 0.0  # Total time between pushing and taking the samples in seconds
+        self.max_latency = 0.0
+
+    # Called by the producer. Returns False if the sample was dropped
+    def push(self, sample):
+        if self.write_index - self.read_index >= self.capacity:
+            self.dropped += 1
+            return False
+        self.slots[self.write_index % self.capacity] = (time.perf_counter(), sample)
+        self.write_index += 1
+        return True
+
+    # Called by the consumer. Returns all waiting (timestamp, sample) pairs, the oldest first
+    def pop_all(self):
+        end = self.write_index
+        samples = [self.slots[i % self.capacity] for i in range(self.read_index, end)]
+        self.read_index = end
+
+        if len(samples) > 0:
+            now = time.perf_counter()
+            self.max_depth = max(self.max_depth, len(samples))
+            self.time_of_latencies += sum(now - timestamp for timestamp, sample in samples)
+            self.max_latency = max(self.max_latency, now - samples[0][0])
+        return samples
+
+    def __len__(self):
+        return self.write_index - self.read_index
+
+    # Returns the current and largest depth, the number of samples and how long they waited for the game loop
+    def get_stats(self):
+        taken = self.read_index
+        mean_latency = 0.0
+        if taken > 0:
+            mean_latency = self.time_of_latencies / taken * 1000
+        return {"depth": len(self), "max_depth": self.max_depth, "pushed": self.write_index, "dropped": self.dropped,
+                "mean_latency_ms": mean_latency, "max_latency_ms": self.max_latency * 1000}
+
+
+"""
+Filters for the cursor position. Each IR sample of the pointing Wiimote is passed to filter() and the filtered position
+is returned immediately, so the cursor moves with every sample.
+MovingAverageFilter is the mean of the last size positions. They are kept in a ring and the sums are updated with the
+new and the oldest value, so a sample costs the same for every size.
+OneEuroFilter is the adaptive low pass filter from Casiez, G., Roussel, N. and Vogel, D. (2012). 1 € filter: a simple
+speed-based low-pass filter for noisy input in interactive systems. It smooths a lot if the cursor is held still and
+only a little if it moves fast, which reduces the jitter without lagging behind fast movements.
+"""
+
+
+class MovingAverageFilter:
+
+    def __init__(self, size):
+        self.size = size
+        self.x_values = [0] * size
+        self.y_values = [0] * size
+        self.reset()
+
+    def reset(self):
+        self.position = 0  # Index the next value is written to
+        self.count = 0  # Number of values in the ring
+        self.sum_of_x = 0
+        self.sum_of_y = 0
+
+    def filter(self, x, y, timestamp):
+        if self.count == self.size:  # Remove the oldest value from the sums
+            self.sum_of_x -= self.x_values[self.position]
+            self.sum_of_y -= self.y_values[self.position]
+        else:
+            self.count += 1
+        self.x_values[self.position] = x
+        self.y_values[self.position] = y
+        self.sum_of_x += x
+        self.sum_of_y += y
+        self.position = (self.position + 1) % self.size
+
+        return self.sum_of_x / self.count, self.sum_of_y / self.count
+
+
+class OneEuroFilter:
+
+    def __init__(self, min_cutoff=1.0, beta=0.007, derivative_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.derivative_cutoff = derivative_cutoff  # Cutoff frequency for the speed of the cursor (in Hz)
+        self.reset()
+
+    def reset(self):
+        self.x = None  # Last filtered position
+        self.y = None
+        self.speed_x = 0.0  # Filtered speed in pixel per second
+        self.speed_y = 0.0
+        self.timestamp = None  # Time of the last sample in seconds
+
+    # Weight of the new value of an exponential smoothing with the given cutoff frequency
+    @staticmethod
+    def smoothing_factor(cutoff, interval):
+        r = 2 * math.pi * cutoff * interval
+        return r / (r + 1)
+
+    def filter(self, x, y, timestamp):
+        if self.x is None:
+            self.x, self.y, self.timestamp = x, y, timestamp
+            return x, y
+        interval = timestamp - self.timestamp
+        if interval <= 0:  # Two samples with the same timestamp
+            return self.x, self.y
+        self.timestamp = timestamp
+
+        a = OneEuroFilter.smoothing_factor(self.derivative_cutoff, interval)
+        self.speed_x += a * ((x - self.x) / interval - self.speed_x)
+        self.speed_y += a * ((y - self.y) / interval - self.speed_y)
+
+        cutoff = self.min_cutoff + self.beta * math.hypot(self.speed_x, self.speed_y)
+        a = OneEuroFilter.smoothing_factor(cutoff, interval)
+        self.x += a * (x - self.x)
+        self.y += a * (y - self.y)
+        return self.x, self.y
+
+
+"""
+Recording and replaying the data of the Wiimotes, so the game can be run and profiled without Wiimotes.
+A recording is a binary file with a header (HEADER_DTYPE) followed by records with a fixed size (RECORD_DTYPE). Each
+record has the time since the start of the recording, the number of the Wiimote (in the order they were connected)
+and either the IR data (number of LEDs and their x and y values), the state of all buttons as bits or the values of the
+accelerometer. The records can be read with np.memmap without parsing the file.
+"""
+
+
+class WiimoteRecorder:
+
+    IR, BUTTONS, ACCELEROMETER = 0, 1, 2  # Kinds of records
+    MAGIC = b"WIIMOTE1"  # First bytes of a recording
+    HEADER_DTYPE = np.dtype([("magic", "S8"), ("num_devices", "<u4"), ("num_records", "<u4")])
+    RECORD_DTYPE = np.dtype([("time", "<f8"), ("device", "u1"), ("kind", "u1"), ("count", "u1"), ("unused", "u1"),
+                             ("buttons", "<u2"), ("values", "<i2", (8,))])
+    BUTTON_NAMES = ["A", "B", "Home", "Up", "Down", "Left", "Right", "One", "Two", "Plus", "Minus"]
+    CHUNK_SIZE = 4096  # The records are collected in an array of this size, which is written at once
+
+    # clock returns the current time in seconds. Synthetic recordings can pass their own clock
+    def __init__(self, filename, clock=time.perf_counter):
+        self.file = open(filename, "wb")
+        # The header is written again with the right values by close()
+        self.file.write(np.zeros(1, WiimoteRecorder.HEADER_DTYPE).tobytes())
+        self.chunk = np.zeros(WiimoteRecorder.CHUNK_SIZE, WiimoteRecorder.RECORD_DTYPE)
+        self.chunk_position = 0
+        self.num_records = 0
+        self.devices = []  # The wrapped Wiimotes
+        self.last_buttons = []  # Last recorded state of the buttons of each Wiimote
+        self.lock = threading.Lock()  # The IR data is recorded by the thread of the wiimote library
+        self.clock = clock
+        self.start = clock()
+
+    # Stands in for wiimote.connect: connects the Wiimote with the passed function and records its data
+    def wrap_connect(self, connect):
+        def connect_and_record(address, name=None):
+            device = RecordingWiimote(connect(address, name), self, len(self.devices))
+            self.devices.append(device)
+            self.last_buttons.append(None)
+            return device
+        return connect_and_record
+
+    def add_record(self, device, kind, count=0, buttons=0, values=()):
+        values = tuple(values) + (0,) * (8 - len(values))
+        timestamp = self.clock() - self.start
+        with self.lock:
+            if self.file.closed:  # The callback thread can still deliver IR data after the game has been closed
+                return
+            self.chunk[self.chunk_position] = (timestamp, device, kind, count, 0, buttons, values)
+            self.chunk_position += 1
+            self.num_records += 1
+            if self.chunk_position == len(self.chunk):
+                self.flush()
+
+    def record_ir(self, device, ir_data):
+        values = []
+        for led in ir_data[:4]:
+            values.extend((led["x"], led["y"]))
+        self.add_record(device, WiimoteRecorder.IR, count=len(values) // 2, values=values)
+
+    # The buttons and the accelerometer are read by the game loop, so they are recorded once per frame. The buttons
+    # are only recorded if they changed
+    def record_states(self):
+        for device in self.devices:
+            wiimote = device.wiimote
+            buttons = 0
+            for i in range(len(WiimoteRecorder.BUTTON_NAMES)):
+                if wiimote.buttons[WiimoteRecorder.BUTTON_NAMES[i]]:
+                    buttons |= 1 << i
+            if buttons != self.last_buttons[device.number]:
+                self.last_buttons[device.number] = buttons
+                self.add_record(device.number, WiimoteRecorder.BUTTONS, buttons=buttons)
+            # The accelerometer of the wiimote library can only be indexed with integers, like in recognize_activity
+            accelerometer = wiimote.accelerometer
+            self.add_record(device.number, WiimoteRecorder.ACCELEROMETER, count=3,
+                            values=(accelerometer[0], accelerometer[1], accelerometer[2]))
+
+    # Writes the collected records to the file. Has to be called with the lock
+    def flush(self):
+        self.file.write(self.chunk[:self.chunk_position].tobytes())
+        self.chunk_position = 0
+
+    # Writes the remaining records and the header. Can be called more than once
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.flush()
+            header = np.zeros(1, WiimoteRecorder.HEADER_DTYPE)
+            header["magic"] = WiimoteRecorder.MAGIC
+            header["num_devices"] = len(self.devices)
+            header["num_records"] = self.num_records
+            self.file.seek(0)
+            self.file.write(header.tobytes())
+            self.file.close()
+
+
+"""
+This class wraps a connected Wiimote for the WiimoteRecorder. The IR data is recorded before it is passed to the
+callback of the game, everything else is passed through to the Wiimote.
+"""
+
+
+class RecordingWiimote:
+
+    def __init__(self, wiimote, recorder, number):
+        self.wiimote = wiimote
+        self.recorder = recorder
+        self.number = number  # Index of the Wiimote in the recording
+        self.ir = self  # The game calls ir.register_callback
+
+    def register_callback(self, callback):
+        def record_and_call(ir_data):
+            self.recorder.record_ir(self.number, ir_data)
+            callback(ir_data)
+        self.wiimote.ir.register_callback(record_and_call)
+
+    @property
+    def buttons(self):
+        return self.wiimote.buttons
+
+    @property
+    def accelerometer(self):
+        return self.wiimote.accelerometer
+
+    @property
+    def leds(self):
+        return self.wiimote.leds
+
+    @leds.setter
+    def leds(self, leds):
+        self.wiimote.leds = leds
+
+
+"""
+This class replays a recording of the WiimoteRecorder. connect() stands in for wiimote.connect and returns the replayed
+Wiimotes in the order they were connected while recording. The records can either be replayed by a thread like they
+were recorded (start, with a speed factor or as fast as possible), or step by step by the caller (advance), which
+makes runs deterministic: advance(1 / FPS) in every frame always replays the same records in the same frame.
+"""
+
+
+class WiimoteReplay:
+
+    def __init__(self, filename):
+        header = np.fromfile(filename, WiimoteRecorder.HEADER_DTYPE, count=1)
+        if len(header) == 0 or header["magic"][0] != WiimoteRecorder.MAGIC:
+            raise ValueError("Not a Wiimote recording: " + str(filename))
+        self.records = np.memmap(filename, WiimoteRecorder.RECORD_DTYPE, mode="r",
+                                 offset=WiimoteRecorder.HEADER_DTYPE.itemsize, shape=(int(header["num_records"][0]),))
+        self.devices = [ReplayedWiimote() for i in range(int(header["num_devices"][0]))]
+        self.num_connected = 0
+        self.position = 0  # Index of the next record
+        self.replay_time = 0.0  # Time in the recording up to which the records have been replayed
+        self.thread = None
+
+    def connect(self, address, name=None):
+        if self.num_connected >= len(self.devices):
+            raise ValueError("The recording only contains " + str(len(self.devices)) + " Wiimotes")
+        device = self.devices[self.num_connected]
+        self.num_connected += 1
+        return device
+
+    # Replays the record at the current position
+    def replay_record(self):
+        record = self.records[self.position]
+        device = self.devices[record["device"]]
+        self.position += 1
+
+        if record["kind"] == WiimoteRecorder.IR:
+            values = record["values"].tolist()
+            ir_data = [{"x": values[2 * i], "y": values[2 * i + 1]} for i in range(record["count"])]
+            if device.ir.callback is not None:
+                device.ir.callback(ir_data)
+        elif record["kind"] == WiimoteRecorder.BUTTONS:
+            buttons = int(record["buttons"])
+            names = WiimoteRecorder.BUTTON_NAMES
+            device.buttons = {names[i]: bool(buttons & (1 << i)) for i in range(len(names))}
+        elif record["kind"] == WiimoteRecorder.ACCELEROMETER:
+            device.accelerometer = tuple(record["values"][:3].tolist())
+
+    # Replays all records of the next duration seconds of the recording. Returns False at the end of the recording
+    def advance(self, duration):
+        self.replay_time += duration
+        times = self.records["time"]
+        while self.position < len(self.records) and times[self.position] < self.replay_time:
+            self.replay_record()
+        return not self.is_finished()
+
+    def is_finished(self):
+        return self.position >= len(self.records)
+
+    # Replays the records in a thread. speed 2.0 is twice as fast as recorded, None as fast as possible
+    def start(self, speed=1.0):
+        self.thread = threading.Thread(target=self.run, args=(speed,), daemon=True)
+        self.thread.start()
+
+    def run(self, speed):
+        start = time.perf_counter()
+        times = self.records["time"]
+        while not self.is_finished():
+            if speed is not None:
+                delay = times[self.position] / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.replay_record()
+
+
+"""
+A Wiimote replayed by the WiimoteReplay. It has the same attributes as the Wiimotes of the wiimote library that are used
+by the game.
+"""
+
+
+class ReplayedWiimote:
+
+    def __init__(self):
+        self.ir = ReplayedIr()
+        self.buttons = {name: False for name in WiimoteRecorder.BUTTON_NAMES}
+        self.accelerometer = (0, 0, 0)
+        self.leds = [0, 0, 0, 0]
+
+
+class ReplayedIr:
 
     def __init__(self):
+        self.callback = None
+
+    def register_callback(self, callback):
+        self.callback = callback
+
+
+"""
+This class measures how long the stages of each iteration of the game loop take. lap() is called after each stage
+and adds the time since the last call to that stage. The durations are counted in histograms with a fixed number of
+logarithmic buckets (10 per decade from 1 us to 1 s), so the memory does not grow while the game is running. The last
+WINDOW_SIZE frames are kept as well, for showing the current averages in the overlay. If the profiler is disabled,
+start_frame() and lap() return immediately.
+"""
+
+
+class FrameProfiler:
+
+    STAGES = ["wait", "input", "game_logic", "draw", "activity", "hud", "present", "events", "frame"]
+    WAIT, INPUT, GAME_LOGIC, DRAW, ACTIVITY, HUD, PRESENT, EVENTS, FRAME = range(len(STAGES))  # FRAME: whole frame
+    SMALLEST_DURATION = 1e-6  # Lower edge of the first bucket in seconds
+    BUCKETS_PER_DECADE = 10
+    NUM_BUCKETS = 60
+    WINDOW_SIZE = 120
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = np.zeros((len(FrameProfiler.STAGES), FrameProfiler.NUM_BUCKETS), dtype=np.int64)
+        self.totals = [0.0] * len(FrameProfiler.STAGES)  # Sum of all durations of each stage in seconds
+        self.window = np.zeros((len(FrameProfiler.STAGES), FrameProfiler.WINDOW_SIZE))
+        self.window_position = 0
+        self.num_frames = 0
+        self.durations = [0.0] * len(FrameProfiler.STAGES)  # Durations of the stages of the current frame
+        self.frame_start = None
+        self.last_lap = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.frame_start = None  # A frame that is interrupted by toggling is not counted
+        self.last_lap = None
+
+    def start_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.durations[FrameProfiler.FRAME] = now - self.frame_start
+            self.add_frame()
+        self.frame_start = now
+        self.last_lap = now
+        self.durations = [0.0] * len(FrameProfiler.STAGES)
+
+    def lap(self, stage):
+        if not self.enabled or self.last_lap is None:
+            return
+        now = time.perf_counter()
+        self.durations[stage] += now - self.last_lap
+        self.last_lap = now
+
+    # Adds the durations of the finished frame to the histograms and the window
+    def add_frame(self):
+        for stage in range(len(self.durations)):
+            duration = self.durations[stage]
+            self.totals[stage] += duration
+            self.window[stage, self.window_position] = duration
+            bucket = 0
+            if duration > FrameProfiler.SMALLEST_DURATION:
+                bucket = int(math.log10(duration / FrameProfiler.SMALLEST_DURATION) * FrameProfiler.BUCKETS_PER_DECADE)
+                bucket = min(bucket, FrameProfiler.NUM_BUCKETS - 1)
+            self.histograms[stage, bucket] += 1
+        self.window_position = (self.window_position + 1) % FrameProfiler.WINDOW_SIZE
+        self.num_frames += 1
+
+    # Returns the average duration of each stage over the last frames in milliseconds
+    def get_averages(self):
+        num_frames = min(self.num_frames, FrameProfiler.WINDOW_SIZE)
+        if num_frames == 0:
+            return {}
+        averages = self.window[:, :num_frames].mean(axis=1) * 1000
+        return {FrameProfiler.STAGES[i]: float(averages[i]) for i in range(len(FrameProfiler.STAGES))}
+
+    # The frame rate over the last frames
+    def get_fps(self):
+        frame = self.get_averages().get("frame", 0.0)
+        if frame == 0:
+            return 0.0
+        return 1000 / frame
+
+    # Upper edges of the buckets in milliseconds
+    @staticmethod
+    def get_bucket_edges():
+        exponents = np.arange(1, FrameProfiler.NUM_BUCKETS + 1) / FrameProfiler.BUCKETS_PER_DECADE
+        return FrameProfiler.SMALLEST_DURATION * 1000 * 10 ** exponents
+
+    # Smallest upper bucket edge below which the given share of the durations of the stage lies (in milliseconds)
+    def get_percentile(self, stage, share):
+        counts = np.cumsum(self.histograms[stage])
+        if counts[-1] == 0:
+            return 0.0
+        return float(FrameProfiler.get_bucket_edges()[np.searchsorted(counts, share * counts[-1])])
+
+    # Writes the histograms of all stages and the passed measurements (e.g. of the recognition thread) to a JSON file.
+    # Nothing is written if no frame has been measured
+    def export(self, filename, extra=None):
+        if self.num_frames == 0:
+            return
+        stages = {}
+        for i in range(len(FrameProfiler.STAGES)):
+            stages[FrameProfiler.STAGES[i]] = {
+                "mean_ms": self.totals[i] / self.num_frames * 1000,
+                "p50_ms": self.get_percentile(i, 0.5),
+                "p99_ms": self.get_percentile(i, 0.99),
+                "counts": self.histograms[i].tolist()
+            }
+        data = {"frames": self.num_frames, "bucket_upper_edges_ms": FrameProfiler.get_bucket_edges().tolist(),
+                "stages": stages}
+        if extra is not None:
+            data.update(extra)
+        with open(filename, "w") as file:
+            json.dump(data, file, indent=2)
+
+
+class WiimoteGame:
+
+    # The recording that is replayed instead of using the Wiimotes and whether it is replayed frame by frame. If they
+    # are not passed, Constants.WIIMOTE_REPLAY_FILE and Constants.WIIMOTE_REPLAY_PER_FRAME are used
+    def __init__(self, replay_file=None, replay_per_frame=None):
         super().__init__()
 
-        self.gesture_recognizer = GestureRecognizer()
-        self.activity_recognizer = ActivityRecognizer()
+        self.gesture_recognizer = GestureRecognizer(Constants.GESTURE_RECOGNITION_METHOD)
+        self.activity_recognizer = ActivityRecognizer(Constants.ACTIVITY_HOP_SIZE,
+                                                      features=Constants.ACTIVITY_FEATURES,
+                                                      classifier=Constants.ACTIVITY_CLASSIFIER)
+
+        self.profiler = FrameProfiler(Constants.PROFILER_ENABLED)  # Measures the stages of the game loop
+        self.profiler_overlay = None  # Rendered text of the profiler, updated twice per second
+        self.profiler_overlay_time = 0.0
+        self.replay = None  # WiimoteReplay, if a recording is played instead of using the Wiimotes
+        self.replay_file = replay_file if replay_file is not None else Constants.WIIMOTE_REPLAY_FILE
+        self.replay_per_frame = replay_per_frame if replay_per_frame is not None else Constants.WIIMOTE_REPLAY_PER_FRAME
+        self.recorder = None  # WiimoteRecorder, if the data of the Wiimotes is recorded
+
+        # Raw IR samples of the Wiimotes, pushed by the callbacks and processed once per frame by the game loop
+        self.pointer_samples = SampleQueue(Constants.IR_SAMPLE_QUEUE_SIZE)
+        self.tracker_samples = SampleQueue(Constants.IR_SAMPLE_QUEUE_SIZE)
+
+        # Smooths the cursor position, see Constants.POINTER_FILTER
+        if Constants.POINTER_FILTER == "one_euro":
+            self.pointer_filter = OneEuroFilter(Constants.ONE_EURO_MIN_CUTOFF, Constants.ONE_EURO_BETA)
+        else:
+            self.pointer_filter = MovingAverageFilter(Constants.MOVING_AVERAGE_NUM_VALUES)
 
         # Buffered values:
-        self.pointer_x_values = []
-        self.pointer_y_values = []
         self.drawing_x_values = []
         self.drawing_y_values = []
 
         self.currently_drawing = False  # Flag: Is player drawind
         self.drawing_ok = False  # Has the barricade been recognized as a square by the $1 Gesture recognizer
+        self.current_gesture = IncrementalGesture(self.gesture_recognizer)  # The drawing while A is held
+        self.recognition_worker = RecognitionWorker()  # Recognizes finished drawings in the background
+        self.pending_barricade = {}  # Barricade of the finished drawing, placed as soon as it has been recognized
 
         self.barricade = {}  # Contains the current barricade, if one exists
+        self.hint = None  # Hint that is drawn over the background in the current frame (e.g. if the drawing is too big)
 
         self.enemies_at_once = 1  # How many enemies can spawn right now
         self.enemies_incrementor = 0
@@ -141,6 +1046,9 @@ class WiimoteGame:
 
     # Init pygame components
     def init_pygame(self):
+        Constants.init_display()
+        self.renderer = Renderer(Constants.DIRTY_RECT_RENDERING)
+        self.background_compositor = BackgroundCompositor(Constants.BACKGROUND_OFFSET_STEP)
         self.init_canvas()
         self.init_sprites()
         self.clock = pygame.time.Clock()
@@ -148,40 +1056,50 @@ class WiimoteGame:
 
     # sets up game canvas (Main canvas and the two HUD lines)
     def init_canvas(self):
+        self.info_line = HudWidget((0, 0), (Constants.WIDTH, 50), self.build_info_line)
+        self.munition_line = HudWidget((0, Constants.HEIGHT - 50), (Constants.WIDTH, 50), self.build_munition_line)
         self.drawInfoLine("Highscore: 0")
         self.drawGameCanvas()
         self.drawMunitionLine(Constants.MUNITION_COUNT, Constants.MAX_NUM_LIVES)
 
-    # draws the upper line that displays the highscore on the screen
+    # draws the upper line that displays the highscore on the screen. It is only rebuilt if the text changed
     def drawInfoLine(self, text):
-        self.info_line_top = pygame.Surface((Constants.WIDTH, 50))
-        self.info_line_top = self.info_line_top.convert()
-        self.info_line_top.fill((250, 250, 250))
-        font = pygame.font.Font(None, 50)
-        self.text = font.render(text, 1, (10, 10, 10))
-        textpos = self.text.get_rect()
-        textpos.centerx = self.info_line_top.get_rect().centerx
-        self.info_line_top.blit(self.text, textpos)
-        Constants.SCREEN.blit(self.info_line_top, (0, 0))
+        rect = self.info_line.draw(text)
+        if self.info_line.changed:
+            self.renderer.add(rect)
+
+    # draws the text of the info line onto the surface of the HUD widget
+    def build_info_line(self, surface, text):
+        surface.fill((250, 250, 250))
+        text_surface = TextCache.render(text, 50, (10, 10, 10))
+        textpos = text_surface.get_rect()
+        textpos.centerx = surface.get_rect().centerx
+        surface.blit(text_surface, textpos)
 
     # draws the main game canvas
     def drawGameCanvas(self):
         self.game_canvas = pygame.Surface((Constants.WIDTH, Constants.HEIGHT))
         Constants.SCREEN.blit(self.game_canvas, (0, 50))
 
-    # draws the lower line on the canvas that displays the munition and lives of the player
+    # draws the lower line on the canvas that displays the munition and lives of the player. It is only rebuilt if
+    # the munition or the lives changed
     def drawMunitionLine(self, num_bullets, lives):
-        self.munition_line = pygame.Surface((Constants.WIDTH, 50))
-        self.munition_line.fill((250, 250, 250))
-        Constants.SCREEN.blit(self.munition_line, (0, Constants.HEIGHT - 50))
+        rect = self.munition_line.draw((num_bullets, lives))
+        if self.munition_line.changed:
+            self.renderer.add(rect)
+
+    # draws the bullets and hearts onto the surface of the HUD widget
+    def build_munition_line(self, surface, values):
+        num_bullets, lives = values
+        surface.fill((250, 250, 250))
 
-        bullet = Constants.BULLET_IMAGE  # Draw bullets on screen
+        bullet = Assets.get_bullet_image()  # Draw bullets
         for i in range(num_bullets):
-            Constants.SCREEN.blit(bullet, (Constants.WIDTH - i*20 - 20, Constants.HEIGHT - 50, 100, 100))
+            surface.blit(bullet, (Constants.WIDTH - i*20 - 20, 0))
 
-        heart = Constants.HEART_IMAGE  # Draw hearts on screen
+        heart = Assets.get_heart_image()  # Draw hearts
         for i in range(lives):
-            Constants.SCREEN.blit(heart, (i*50 + 10, Constants.HEIGHT - 40, 100, 100))
+            surface.blit(heart, (i*50 + 10, 10))
 
     # adds all sprites, i.e. game elements to the screen
     def init_sprites(self):
@@ -228,6 +1146,15 @@ class WiimoteGame:
 
     # Start the pairing process, done like in wiimote_demo.py
     def connect_wiimotes(self):
+        if self.replay_file:
+            self.replay = WiimoteReplay(self.replay_file)
+            connect = self.replay.connect
+        else:
+            import wiimote  # Only needed if the game is started, not if single classes are used by other scripts
+            connect = wiimote.connect
+        if Constants.WIIMOTE_RECORDING_FILE:
+            self.recorder = WiimoteRecorder(Constants.WIIMOTE_RECORDING_FILE)
+            connect = self.recorder.wrap_connect(connect)
 
         tracker = Constants.WIIMOTE_TRACKER_ADDRESS
         pointer = Constants.WIIMOTE_POINTER_ADDRESS
@@ -240,19 +1167,48 @@ class WiimoteGame:
             tracker = sys.argv[1]
             pointer = sys.argv[2]
 
-        self.wm_tracker = wiimote.connect(tracker, None)
+        self.wm_tracker = connect(tracker, None)
         self.wm_tracker.ir.register_callback(self.get_ir_data_of_tracker)
         self.wm_tracker.leds = [0, 1, 0, 0]
 
-        self.wm_pointer = wiimote.connect(pointer, None)
+        self.wm_pointer = connect(pointer, None)
         self.wm_pointer.ir.register_callback(self.get_ir_data_of_pointer)
         self.wm_pointer.leds = [1, 0, 0, 0]
 
+        if self.replay is not None and not self.replay_per_frame:
+            self.replay.start(Constants.WIIMOTE_REPLAY_SPEED)
+
         # As soon as the Wiimotes are connected, start the loop
         self.start_loop()
 
-    # Get the IR data from the "Pointer" Wiimote
+    # Get the IR data from the "Pointer" Wiimote. Called by the thread of the wiimote library, so the data is only
+    # queued for the game loop
     def get_ir_data_of_pointer(self, ir_data):
+        self.pointer_samples.push(ir_data)
+
+    # Get the IR data from the "Tacker" Wiimote. Called by the thread of the wiimote library, like above
+    def get_ir_data_of_tracker(self, ir_data):
+        self.tracker_samples.push(ir_data)
+
+    # Processes the IR samples that have been queued since the last frame, in the order they arrived. The cursor and
+    # the player are only changed here, by the thread of the game loop
+    def process_ir_samples(self):
+        cursor = None
+        for timestamp, ir_data in self.pointer_samples.pop_all():
+            cursor = self.process_ir_data_of_pointer(ir_data, timestamp) or cursor
+        # Every sample is filtered, but the cursor only needs to be moved to the newest position once per frame
+        if cursor is not None:
+            pygame.mouse.set_pos(cursor)
+        for timestamp, ir_data in self.tracker_samples.pop_all():
+            self.process_ir_data_of_tracker(ir_data)
+
+    # Returns the state of the queues of the IR samples
+    def get_input_stats(self):
+        return {"pointer": self.pointer_samples.get_stats(), "tracker": self.tracker_samples.get_stats()}
+
+    # Calculates the filtered cursor position from the IR data of the "Pointer" Wiimote. Returns None if the IR data
+    # is not usable or the position is not on the screen
+    def process_ir_data_of_pointer(self, ir_data, timestamp):
         if len(ir_data) == 4:
             led_one = (ir_data[0]["x"], ir_data[0]["y"])
             led_two = (ir_data[1]["x"], ir_data[1]["y"])
@@ -263,37 +1219,18 @@ class WiimoteGame:
             if led_one[0] == 1023 and led_one[1] == 1023:
                 return
 
-            x, y = self.pointing.process_ir_data(led_one, led_two, led_three, led_four)
-
-            # Collect values in list
-            self.pointer_x_values.append(x)
-            self.pointer_y_values.append(y)
-
-            # Filter values using the moving average filter
-            if len(self.pointer_x_values) == Constants.MOVING_AVERAGE_NUM_VALUES:
-                filtered_x, filtered_y = self.moving_average(self.pointer_x_values, self.pointer_y_values)
-                self.pointer_x_values = []
-                self.pointer_y_values = []
-                # Only update the cursor if it is on the screen
-                if filtered_x >= 0 and filtered_x <= Constants.WIDTH and \
-                        filtered_y >= 0 and filtered_y <= Constants.HEIGHT:
-                    pygame.mouse.set_pos([filtered_x, filtered_y])
-
-    # Simple implementation of the moving average filter
-    def moving_average(self, x_values, y_values):
-        sum_of_x = 0
-        sum_of_y = 0
-        for i in range(len(x_values)):
-            sum_of_x += x_values[i]
-            sum_of_y += y_values[i]
-
-        filtered_x = sum_of_x/len(x_values)
-        filtered_y = sum_of_y/len(y_values)
+            point = self.pointing.process_ir_data(led_one, led_two, led_three, led_four)
+            if point is None:  # The LEDs do not allow a projection, the cursor stays where it is
+                return
+            filtered_x, filtered_y = self.pointer_filter.filter(point[0], point[1], timestamp)
 
-        return filtered_x, filtered_y
+            # Only update the cursor if it is on the screen
+            if filtered_x >= 0 and filtered_x <= Constants.WIDTH and \
+                    filtered_y >= 0 and filtered_y <= Constants.HEIGHT:
+                return filtered_x, filtered_y
 
-    # Get the IR data from the "Tacker" Wiimote
-    def get_ir_data_of_tracker(self, ir_data):
+    # Calculates the player position from the IR data of the "Tacker" Wiimote
+    def process_ir_data_of_tracker(self, ir_data):
         if len(ir_data) == 2:  # Looking for the two LEDs of the helmet
 
             # Check if the Wiimote is outputting wrong values. (If IR is not working, x and y values will be 1023)
@@ -314,8 +1251,13 @@ class WiimoteGame:
     def start_loop(self):
         self.reset_game()
         loop_running = True
-        while loop_running:
-            self.loop_iteration()
+        try:
+            while loop_running:
+                self.loop_iteration()
+        finally:
+            # Every way of leaving the game (quit_game, an exception or Ctrl+C) ends here, so the recording is usable
+            if self.recorder is not None:
+                self.recorder.close()
 
     # resets game after game over
     def reset_game(self):
@@ -329,7 +1271,9 @@ class WiimoteGame:
         self.game_over = False
         self.shoot_enemy_anim_iterator = 0
         self.bullet_holes = []
+        self.highscore_entries = None  # Highscore list shown on the game over screen, read when it is displayed
         self.play_music()
+        self.renderer.invalidate()  # Redraw the whole screen after the game over screen
 
         for enemy in self.enemies:
             self.enemies.remove(enemy)
@@ -341,22 +1285,79 @@ class WiimoteGame:
 
     # One iteration of the loop: 1/60 sec
     def loop_iteration(self):
+        profiler = self.profiler
+        profiler.start_frame()
 
         self.clock.tick(Constants.FPS)
+        profiler.lap(FrameProfiler.WAIT)
+        if self.recorder is not None:
+            self.recorder.record_states()
+        if self.replay is not None and self.replay_per_frame:
+            self.replay.advance(1 / Constants.FPS)
+        self.process_ir_samples()
         self.check_wiimote_input()
+        profiler.lap(FrameProfiler.INPUT)
 
         if not self.game_over:
             self.update_game_logic()
+            profiler.lap(FrameProfiler.GAME_LOGIC)
             self.draw_game_elements()
+            profiler.lap(FrameProfiler.DRAW)
 
             self.recognize_activity()  # recognize gesture. Looks for reload of gun
+            profiler.lap(FrameProfiler.ACTIVITY)
             self.drawInfoLine("Score: " + str(self.highscore))  # Update displayed Score
             self.drawMunitionLine(self.munition_counter, self.lives)  # Update Lifes and Ammo
         else:
+            self.renderer.invalidate()  # The game over screen is always drawn completely
             self.display_game_over_screen()
+            profiler.lap(FrameProfiler.DRAW)
+        self.draw_profiler_overlay()
+        profiler.lap(FrameProfiler.HUD)
 
-        pygame.display.flip()  # Update the display
+        self.renderer.present()  # Update the display
+        profiler.lap(FrameProfiler.PRESENT)
         self.init_pygame_events()
+        profiler.lap(FrameProfiler.EVENTS)
+
+    # Shows the average duration of the stages of the game loop over the last frames and the frame rate, while the
+    # profiler is enabled. The text is only rendered again twice per second
+    def draw_profiler_overlay(self):
+        if not self.profiler.enabled:
+            return
+        now = time.perf_counter()
+        if self.profiler_overlay is None or now - self.profiler_overlay_time > 0.5:
+            self.profiler_overlay = self.build_profiler_overlay()
+            self.profiler_overlay_time = now
+        position = (Constants.WIDTH - self.profiler_overlay.get_width() - 10, 60)
+        self.renderer.add(Constants.SCREEN.blit(self.profiler_overlay, position))
+
+    def build_profiler_overlay(self):
+        font = TextCache.get_font(24)
+        averages = self.profiler.get_averages()
+        lines = ["FPS: {:.1f}".format(self.profiler.get_fps())]
+        for stage in FrameProfiler.STAGES:
+            lines.append("{}: {:.2f} ms".format(stage, averages.get(stage, 0.0)))
+        # The recognition of the drawings runs in the background, so it is not part of the frame time
+        recognition = self.recognition_worker.get_stats()
+        lines.append("drawing: {:.2f} ms".format(recognition["recognitions"]["median_ms"]))
+        lines.append("provisional: {:.2f} ms".format(recognition["provisional"]["median_ms"]))
+
+        surface = pygame.Surface((220, 20 * len(lines) + 10))
+        surface.fill((0, 0, 0))
+        for i in range(len(lines)):
+            surface.blit(font.render(lines[i], 1, (255, 255, 255)), (10, 5 + 20 * i))
+        return surface
+
+    # Closes the recording, stops the recognition thread and writes the histograms of the profiler before the game is
+    # closed
+    def quit_game(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        self.recognition_worker.shutdown()
+        self.profiler.export(Constants.PROFILER_EXPORT_FILE, {"recognition": self.recognition_worker.get_stats()})
+        pygame.quit()
+        exit()
 
     # Player and enemy movement, collision detection, etc.
     def update_game_logic(self):
@@ -377,25 +1378,29 @@ class WiimoteGame:
 
     # Draw updated game elements onto the screen
     def draw_game_elements(self):
+        if self.hint is not None:
+            self.display_hint(self.hint)
+            self.hint = None
         self.enemies.draw(Constants.SCREEN)
+        self.renderer.add_sprites(self.enemies)
         self.draw_user_drawing()
         self.draw_barricade()
         self.draw_bullet_holes()
         self.draw_explosion()
         self.all_sprites.draw(Constants.SCREEN)
+        self.renderer.add_sprites(self.all_sprites)
 
     # Draws the background on the screen. It is composed of three images. Depending on the movement of the head,
     # the two layers of the trees get moved accordingly, to create some sort of a small 3D effect.
     def draw_background_images(self):
-        Constants.SCREEN.blit(Constants.GAME_BACKGROUND_LAYER_1, (0, 0))
-        Constants.SCREEN.blit(Constants.GAME_BACKGROUND_LAYER_2, (-(self.player.get_player_coordinates()[0]
-                                                                    - Constants.WIDTH/2)/100 - 50,
-                                                                  -(self.player.get_player_coordinates()[1]
-                                                                    - Constants.HEIGHT/2)/100))
-        Constants.SCREEN.blit(Constants.GAME_BACKGROUND_LAYER_3, (-(self.player.get_player_coordinates()[0]
-                                                                    - Constants.WIDTH/2)/50 - 50,
-                                                                  -(self.player.get_player_coordinates()[1]
-                                                                    - Constants.HEIGHT/2)/50))
+        player_x, player_y = self.player.get_player_coordinates()
+        offsets = self.background_compositor.get_offsets(player_x, player_y)
+        background = self.background_compositor.get_background(offsets)
+
+        if background is None:
+            self.renderer.draw_background(offsets, lambda: BackgroundCompositor.draw_layers(Constants.SCREEN, offsets))
+        else:
+            self.renderer.draw_background(offsets, lambda: Constants.SCREEN.blit(background, (0, 0)))
 
     # Show the game over screen if necessary
     def display_game_over_screen(self):
@@ -405,15 +1410,13 @@ class WiimoteGame:
         self.draw_highscore()
 
     def draw_game_over_text(self):
-        font = pygame.font.Font(None, 100)
-        game_over_message = font.render("GAME OVER!", 1, (255, 255, 255))
+        game_over_message = TextCache.render("GAME OVER!", 100, (255, 255, 255))
         Constants.SCREEN.blit(game_over_message, game_over_message.get_rect(center=(Constants.WIDTH/2,
                                                                                     1/10 * Constants.HEIGHT)))
 
-        font = pygame.font.Font(None, 36)
-        highscore_message = font.render("Your Score is " + str(self.highscore), 1, (255, 255, 255))
-        restart_message = font.render("Type in your name using the Wiimote D-Pad", 1, (255, 255, 255))
-        save_message = font.render("Press 'Home' to restart", 1, (255, 255, 255), (100, 100, 100))
+        highscore_message = TextCache.render("Your Score is " + str(self.highscore), 36, (255, 255, 255))
+        restart_message = TextCache.render("Type in your name using the Wiimote D-Pad", 36, (255, 255, 255))
+        save_message = TextCache.render("Press 'Home' to restart", 36, (255, 255, 255), (100, 100, 100))
         Constants.SCREEN.blit(highscore_message, highscore_message.get_rect(center=(Constants.WIDTH/2,
                                                                                     2/10 * Constants.HEIGHT)))
         Constants.SCREEN.blit(restart_message, restart_message.get_rect(center=(Constants.WIDTH/2,
@@ -423,16 +1426,14 @@ class WiimoteGame:
 
     # Display the UI that allows a user to enter a name
     def draw_name_input(self):
-        font = pygame.font.Font(None, 200)
-
         letter_font_objects = []
 
         # Draw each of the five letters on by one, using the chars from the "self.playername" list
         for i in range(len(self.player_name)):
             if self.name_input_pos == i:
-                letter_font_objects.append(font.render(self.player_name[i], 1, (255, 0, 0)))
+                letter_font_objects.append(TextCache.render(self.player_name[i], 200, (255, 0, 0)))
             else:
-                letter_font_objects.append(font.render(self.player_name[i], 1, (255, 255, 255)))
+                letter_font_objects.append(TextCache.render(self.player_name[i], 200, (255, 255, 255)))
 
         Constants.SCREEN.blit(letter_font_objects[0], letter_font_objects[0].get_rect(center=(Constants.WIDTH/2 - 400,
                                                                                               Constants.HEIGHT/2)))
@@ -447,15 +1448,17 @@ class WiimoteGame:
 
     # Display the top 10 entries of the highscore on the screen
     def draw_highscore(self):
-        highscore = Highscore().get_highscore()
+        # The highscore file is only read once per game over screen and not on every frame
+        if self.highscore_entries is None:
+            self.highscore_entries = Highscore().get_highscore()
+        highscore = self.highscore_entries
 
-        font = pygame.font.Font(None, 30)
-        highscore_title = font.render("HIGHSCORE", 1, (255, 255, 255), (100, 100, 100))
+        highscore_title = TextCache.render("HIGHSCORE", 30, (255, 255, 255), (100, 100, 100))
         Constants.SCREEN.blit(highscore_title, highscore_title.get_rect(center=(Constants.WIDTH/2,
                                                                                 7/10 * Constants.HEIGHT - 40)))
         for i in range(len(highscore)):
-            highscore_entry = font.render(str(highscore[i][0]) + ": " + str(highscore[i][1]), 1, (255, 255, 255),
-                                          (100, 100, 100))
+            highscore_entry = TextCache.render(str(highscore[i][0]) + ": " + str(highscore[i][1]), 30,
+                                               (255, 255, 255), (100, 100, 100))
             Constants.SCREEN.blit(highscore_entry, highscore_entry.get_rect(center=(Constants.WIDTH/2,
                                                                                     7/10 * Constants.HEIGHT
                                                                                     + (i * 20))))
@@ -480,8 +1483,10 @@ class WiimoteGame:
         # Check if user finished drawing on the screen
         if not self.wm_pointer.buttons['A'] and len(self.drawing_x_values) > 0:
             self.currently_drawing = False
-            self.drawing_ok = self.gesture_recognizer.recognize_drawing(self.drawing_x_values, self.drawing_y_values)
-            self.currently_drawing = False
+            self.calculate_barricade()  # Size and position of the barricade of the finished drawing
+            # The recognition runs in the background, its result is picked up by calculate_barricade
+            self.recognition_worker.submit(self.current_gesture)
+            self.current_gesture = IncrementalGesture(self.gesture_recognizer)
             self.drawing_x_values = []
             self.drawing_y_values = []
 
@@ -493,13 +1498,18 @@ class WiimoteGame:
             if len(self.drawing_x_values) == 0:
                 self.drawing_x_values.append(cursor_pos[0])
                 self.drawing_y_values.append(cursor_pos[1])
+                self.current_gesture.add_point(cursor_pos[0], cursor_pos[1])
             else:
                 if not self.drawing_x_values[-1] == cursor_pos[0] and not self.drawing_y_values[-1] == cursor_pos[-1]:
                     self.drawing_x_values.append(cursor_pos[0])
                     self.drawing_y_values.append(cursor_pos[1])
+                    self.current_gesture.add_point(cursor_pos[0], cursor_pos[1])
 
             if not self.currently_drawing:  # Drawing started if landed here
                 self.barricade = {}
+                self.drawing_ok = False  # The result of the last drawing does not belong to the new one
+                self.recognition_worker.cancel()
+                self.pending_barricade = {}
 
             self.currently_drawing = True
 
@@ -549,17 +1559,22 @@ class WiimoteGame:
                 else:
                     self.name_input_pos += 1
 
-    # Checks if coordinates from a user drawing exist and calculates the size and pos of the barricade accordingly
+    # Checks if coordinates from a user drawing exist and calculates the size and pos of the barricade accordingly.
+    # The barricade is placed as soon as the recognition of the finished drawing is done
     def calculate_barricade(self):
+        finished, drawing_ok = self.recognition_worker.get_result()
+        if finished:
+            self.drawing_ok = drawing_ok
+            if self.drawing_ok and self.pending_barricade:
+                self.barricade = dict(self.pending_barricade, creation_time=time.time())
+            self.pending_barricade = {}
+
         if len(self.drawing_x_values) == 0:
             return
 
         start_x = self.drawing_x_values[0]  # Start pos is the first point from the drawing coordinates
         start_y = self.drawing_y_values[0]
-        min_x = min(self.drawing_x_values)
-        max_x = max(self.drawing_x_values)
-        min_y = min(self.drawing_y_values)
-        max_y = max(self.drawing_y_values)
+        (min_x, min_y), (max_x, max_y) = self.current_gesture.get_bounding_box()  # Updated with every point
 
         width = max_x - min_x
         height = max_y - min_y
@@ -567,7 +1582,8 @@ class WiimoteGame:
         # Notify the user if he wants to draw a barricade is too large (it should not block the entire screen)
         if width > Constants.MAX_BARRICADE_WIDTH or height > Constants.MAX_BARRICADE_HEIGHT:
             self.barricade = {}
-            self.display_hint("Too Big!")
+            self.pending_barricade = {}
+            self.hint = "Too Big!"  # Drawn after the background, calculate_barricade is also called before it
             return
 
         barricade_x = start_x
@@ -580,20 +1596,18 @@ class WiimoteGame:
         if abs(start_y-min_y) > abs(start_y-max_y):
             barricade_y = min_y
 
-        if self.drawing_ok:
-            self.barricade = {
-                "barricade_x": barricade_x,
-                "barricade_y":  barricade_y,
-                "width": width,
-                "height": height,
-                "creation_time": time.time()
-            }
+        self.pending_barricade = {
+            "barricade_x": barricade_x,
+            "barricade_y":  barricade_y,
+            "width": width,
+            "height": height
+        }
 
     #  Display a hint on the screen (e.g. if the drawing is too big)
     def display_hint(self, hint):
-        font = pygame.font.Font(None, 50)
-        self.text = font.render(hint, 1, Constants.HINT_COLOR)
-        Constants.SCREEN.blit(self.text, (pygame.mouse.get_pos()[0] + 100, pygame.mouse.get_pos()[1]))
+        self.text = TextCache.render(hint, 50, Constants.HINT_COLOR)
+        self.renderer.add(Constants.SCREEN.blit(self.text, (pygame.mouse.get_pos()[0] + 100,
+                                                           pygame.mouse.get_pos()[1])))
 
     # Draw the barricade on the screen
     def draw_barricade(self):
@@ -604,10 +1618,9 @@ class WiimoteGame:
             self.drawing_ok = False
 
         if not self.currently_drawing and "barricade_x" in self.barricade.keys():
-            pygame.draw.rect(Constants.SCREEN, Constants.BARRICADE_COLOR, (self.barricade["barricade_x"],
-                                                                           self.barricade["barricade_y"],
-                                                                           self.barricade["width"],
-                                                                           self.barricade["height"]))
+            self.renderer.add(pygame.draw.rect(Constants.SCREEN, Constants.BARRICADE_COLOR,
+                                               (self.barricade["barricade_x"], self.barricade["barricade_y"],
+                                                self.barricade["width"], self.barricade["height"])))
 
     # Check if a button press on the wiimote has happened within the defined time frame
     # This prevents a single button click from beeing interpreted as multiple.
@@ -638,8 +1651,9 @@ class WiimoteGame:
     # Every time the user shoots, a hole is drawn on the screen.
     def draw_bullet_holes(self):
         for i in range(len(self.bullet_holes)):
-            Constants.SCREEN.blit(Constants.BULLET_HOLE_IMAGE, (self.bullet_holes[i][0] - Constants.BULLET_HOLE_SIZE/2,
-                                                                self.bullet_holes[i][1] - Constants.BULLET_HOLE_SIZE/2))
+            self.renderer.add(Constants.SCREEN.blit(Assets.get_bullet_hole_image(),
+                                                    (self.bullet_holes[i][0] - Constants.BULLET_HOLE_SIZE/2,
+                                                     self.bullet_holes[i][1] - Constants.BULLET_HOLE_SIZE/2)))
         if len(self.bullet_holes) > 30:  # If too many holes are on the screen, remove the oldest ones
             del self.bullet_holes[0]
 
@@ -699,9 +1713,18 @@ class WiimoteGame:
     def draw_user_drawing(self):
         if len(self.drawing_x_values) > 0:
             for i in range(len(self.drawing_x_values) - 1):
-                pygame.draw.line(Constants.SCREEN, Constants.DRAWING_COLOR,
-                                 [self.drawing_x_values[i], self.drawing_y_values[i]],
-                                 [self.drawing_x_values[i+1], self.drawing_y_values[i+1]], 10)
+                self.renderer.add(pygame.draw.line(Constants.SCREEN, Constants.DRAWING_COLOR,
+                                                   [self.drawing_x_values[i], self.drawing_y_values[i]],
+                                                   [self.drawing_x_values[i+1], self.drawing_y_values[i+1]], 10))
+
+            # Live feedback: show the shape the drawing looks like so far
+            (min_x, min_y), (max_x, max_y) = self.current_gesture.get_bounding_box()
+            if self.currently_drawing and max_x - min_x <= Constants.MAX_BARRICADE_WIDTH \
+                    and max_y - min_y <= Constants.MAX_BARRICADE_HEIGHT:
+                self.recognition_worker.update_provisional(self.current_gesture)
+                shape = self.current_gesture.get_provisional_match()
+                if shape is not None:
+                    self.display_hint("Looks like a " + shape)
 
     # draws an explosion animation, if the player has just shot an enemy
     def draw_explosion(self):
@@ -726,14 +1749,15 @@ class WiimoteGame:
     def init_pygame_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                pygame.quit()
-                exit()
+                self.quit_game()
 
             # Only for testing with the Mouse instead of the Wiimote
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
-                    pygame.quit()
-                    exit()
+                    self.quit_game()
+                elif event.key == Constants.PROFILER_KEY:
+                    self.profiler.toggle()
+                    self.renderer.invalidate()  # Removes the overlay from the screen
                 elif event.key == pygame.K_RETURN:
                     self.munition_counter = Constants.MUNITION_COUNT
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -811,12 +1835,8 @@ class Enemy(pygame.sprite.Sprite):
         self.id = id
         self.speed = speed
 
-        # sets the image of the enemy objects (randomly select one of five)
-        self.circle_img = pygame.image.load(path.join(Constants.IMG_DIR, str(randint)+".png")).convert()
-        self.image = self.circle_img
-        # scales down image
-        self.image = pygame.transform.scale(self.circle_img, (Constants.ENEMY_SIZE, Constants.ENEMY_SIZE))
-        self.image.set_colorkey((250, 250, 250))  # avoids a black background
+        # sets the image of the enemy objects (randomly select one of five). The image is shared between all enemies
+        self.image = Assets.get_enemy_image(randint)
 
         # specifies position of enemy
         self.rect = self.image.get_rect()
@@ -827,41 +1847,25 @@ class Enemy(pygame.sprite.Sprite):
         # init enemy values
         self.enemy_delay = Constants.ENEMY_DELAY
         self.lose_live = False
-        self.explosion_sprite = []
         self.enemy_sprite = []
         self.collisionY = False
         self.collisionX = False
 
-        self.all_enemies = []
-        enemy_1 = pygame.image.load(path.join(Constants.IMG_DIR, "1.png")).convert()
-        enemy_2 = pygame.image.load(path.join(Constants.IMG_DIR, "2.png")).convert()
-        enemy_3 = pygame.image.load(path.join(Constants.IMG_DIR, "3.png")).convert()
-        enemy_4 = pygame.image.load(path.join(Constants.IMG_DIR, "4.png")).convert()
-
-        self.all_enemies.append(enemy_1)
-        self.all_enemies.append(enemy_2)
-        self.all_enemies.append(enemy_3)
-        self.all_enemies.append(enemy_4)
-
-        # creates a list of all explosion images
-        for x in range(1, 17):
-            explode_img_1 = pygame.image.load(path.join(Constants.IMG_DIR, "explosion_" + str(x) + ".png")).convert()
-            self.explosion_sprite.append(explode_img_1)
+        # the explosion animation (shared between all enemies)
+        self.explosion_animation = Assets.get_explosion_animation()
 
     # sets explosion image to image in list index defined by iterator that is passed in update method
     def explode(self, iterator):
         self.speed = 0  # hinder enemy to move any further if he was shooted
-        self.image = pygame.transform.scale(self.explosion_sprite[iterator], (90, 90))
-        self.image.set_colorkey((0, 0, 0))
+        self.image = self.explosion_animation.get_frame(iterator)
 
-    # gets the length of the image list that represents the explosion animation
+    # gets the number of frames of the explosion animation
     def get_explosion_duration(self):
-        return len(self.explosion_sprite)
+        return len(self.explosion_animation)
 
     # The enemies can track the player. Code example taken from
     # from https://stackoverflow.com/questions/20044791/how-to-make-an-enemy-follow-the-player-in-pygame
     def move_towards_player(self, Player):
-        self.image.set_colorkey((0, 0, 0))  # removes black background from transparent image
         speed = self.speed
         px = Player.rect.centerx
         py = Player.rect.centery
@@ -950,9 +1954,7 @@ This class is responsible for the Crosshair used for aiming
 class Crosshairs(pygame.sprite.Sprite):
     def __init__(self):
         pygame.sprite.Sprite.__init__(self)
-        self.image = Constants.CROSSHAIR_IMAGE  # set crosshair image
-        self.image = pygame.transform.scale(self.image, (Constants.CROSSHAIR_SIZE, Constants.CROSSHAIR_SIZE))
-        self.image.set_colorkey((0, 0, 0))
+        self.image = Assets.get_crosshair_image()  # set crosshair image (scaled and colorkeyed)
         self.rect = self.image.get_rect()
 
         pygame.mouse.set_visible(0)  # Make Mouse Cursor invisible
@@ -964,6 +1966,278 @@ class Crosshairs(pygame.sprite.Sprite):
         self.rect.centery = mousey
 
 
+"""
+Loads the csv templates of a directory in one pass. The lines of all files are parsed with a single call of np.loadtxt
+into one contiguous array instead of parsing every line of every file on its own, which is slow for thousands of
+recorded templates. The rows of the i-th file are data[offsets[i]:offsets[i + 1]].
+"""
+
+
+class TemplateLoader:
+
+    # Returns the names of the files (without directory and ".csv"), the values of all files and the offsets
+    @staticmethod
+    def load(directory, num_columns):
+        names = []
+        lines = []
+        offsets = [0]
+        for csv_file in sorted(glob.glob(path.join(directory, "*.csv"))):
+            with open(csv_file) as file:
+                lines.extend(line for line in file.read().splitlines() if line.strip())
+            names.append(path.splitext(path.basename(csv_file))[0])
+            offsets.append(len(lines))
+
+        if len(lines) == 0:
+            return names, np.empty((0, num_columns)), np.array(offsets)
+        return names, np.loadtxt(lines, delimiter=",", ndmin=2), np.array(offsets)
+
+
+"""
+Feature extraction for the ActivityRecognizer. The classes turn a batch of windows with the shape
+(number of windows, 3, window size) into one row of features per window. fit_transform is called once with the windows
+of all templates when training, transform with the current window while the game is running.
+MeanSpectrumFeatures are the magnitudes of the spectrum of the mean of x, y and z, like in the "Wiimote - FFT - SVM"
+notebook from Grips. BandEnergyFeatures use a real FFT of each axis and reduce it to the energies of a few frequency
+bands plus the mean and the standard deviation of each axis. These are standardized with the values of the templates.
+Both only use values that do not change if a window is rotated, so the ring buffer does not need to be reordered.
+transform_window does the same as transform for the single window of the AccelerometerRingBuffer, but writes into
+arrays that are allocated at the first call, so no memory is allocated while the game is running.
+"""
+
+
+# rfft only has the out parameter since NumPy 2.0. It is checked once, older versions calculate into a new array
+try:
+    rfft(np.zeros(2), out=np.empty(2, complex))
+    RFFT_SUPPORTS_OUT = True
+except TypeError:
+    RFFT_SUPPORTS_OUT = False
+
+
+# Writes the real FFT of the last axis of the values into the preallocated array out
+def rfft_into(values, out):
+    if RFFT_SUPPORTS_OUT:
+        rfft(values, axis=-1, out=out)
+    else:
+        out[...] = rfft(values, axis=-1)
+    return out
+
+
+class MeanSpectrumFeatures:
+
+    def __init__(self):
+        self.buffers = {}  # Arrays used by transform_window for each window size
+
+    def fit_transform(self, windows):
+        return self.transform(windows)
+
+    def transform(self, windows):
+        window_size = windows.shape[-1]
+        return np.abs(rfft(windows.mean(axis=1), axis=-1))[:, 1:window_size // 2] / window_size
+
+    # Same as transform for a window with the shape (1, 3, window size). The result is overwritten by the next call
+    def transform_window(self, window):
+        window_size = window.shape[-1]
+        if window_size not in self.buffers:
+            self.buffers[window_size] = (np.empty((1, window_size)), np.empty((1, window_size // 2 + 1), complex),
+                                         np.empty((1, window_size // 2 - 1)))
+        average, spectrum, features = self.buffers[window_size]
+
+        np.add(window[:, 0], window[:, 1], out=average)
+        np.add(average, window[:, 2], out=average)
+        np.divide(average, 3, out=average)
+        rfft_into(average, spectrum)
+        np.abs(spectrum[:, 1:window_size // 2], out=features)
+        np.divide(features, window_size, out=features)
+        return features
+
+    # Parameters of the features, they are part of the key of the cached classifier
+    def get_params(self):
+        return {}
+
+
+class BandEnergyFeatures:
+
+    def __init__(self, num_bands=6):
+        self.num_bands = num_bands
+        self.offset = None  # Mean of each feature over the templates
+        self.scale = None  # Standard deviation of each feature over the templates
+        self.band_starts = {}  # Index of the first frequency of each band for each window size
+        self.buffers = {}  # Arrays used by transform_window for each window size
+
+    def fit_transform(self, windows):
+        features = self.extract(windows)
+        self.offset = features.mean(axis=0)
+        self.scale = features.std(axis=0)
+        self.scale[self.scale == 0] = 1  # Features that are the same for all templates
+        return (features - self.offset) / self.scale
+
+    def transform(self, windows):
+        return (self.extract(windows) - self.offset) / self.scale
+
+    # Same as transform for a window with the shape (1, 3, window size), calculated step by step in the arrays of
+    # self.buffers. The ufuncs work on whole contiguous arrays where possible, because NumPy needs a temporary buffer
+    # for strided views. The result is overwritten by the next call
+    def transform_window(self, window):
+        window_size = window.shape[-1]
+        if window_size not in self.buffers:
+            num_frequencies = window_size // 2 + 1
+            self.buffers[window_size] = (np.empty((1, 3, num_frequencies), complex), np.empty((1, 3, num_frequencies)),
+                                         np.empty((1, 3, self.num_bands)), np.empty((1, 3, 1)), np.empty((1, 3, 1)),
+                                         np.empty((1, 3, self.num_bands + 2)),
+                                         np.empty((1, 3 * (self.num_bands + 2))))
+        spectrum, power, energies, mean, std, features, standardized = self.buffers[window_size]
+
+        rfft_into(window, spectrum)
+        np.divide(spectrum[..., :1].real, window_size, out=mean)
+        np.abs(spectrum, out=power)  # Frequency 0 is included, but not used below
+        np.square(power, out=power)
+        np.divide(power, window_size, out=power)
+
+        np.add.reduceat(power[..., 1:], self.get_band_starts(window_size, power.shape[-1] - 1), axis=-1, out=energies)
+        np.log1p(energies, out=energies)
+
+        np.sum(power[..., 1:], axis=-1, keepdims=True, out=std)  # Variance like in extract
+        np.multiply(std, 2, out=std)
+        if window_size % 2 == 0:
+            np.subtract(std, power[..., -1:], out=std)
+        np.divide(std, window_size, out=std)
+        np.sqrt(std, out=std)
+
+        np.concatenate((energies, mean, std), axis=-1, out=features)
+        np.subtract(features.reshape(standardized.shape), self.offset, out=standardized)
+        np.divide(standardized, self.scale, out=standardized)
+        return standardized
+
+    # Index of the first frequency of each band
+    def get_band_starts(self, window_size, num_frequencies):
+        if window_size not in self.band_starts:
+            self.band_starts[window_size] = np.linspace(0, num_frequencies, self.num_bands, endpoint=False).astype(int)
+        return self.band_starts[window_size]
+
+    # Energies of the frequency bands (logarithmic), mean and standard deviation of every axis
+    def extract(self, windows):
+        window_size = windows.shape[-1]
+        spectrum = rfft(windows, axis=-1)
+        mean = spectrum[..., :1].real / window_size  # Frequency 0 is the mean
+        power = np.abs(spectrum[..., 1:]) ** 2 / window_size
+
+        energies = np.log1p(np.add.reduceat(power, self.get_band_starts(window_size, power.shape[-1]), axis=-1))
+
+        # Parseval: the variance is the power of all frequencies except 0. The rfft only contains half of them, so
+        # the power is counted twice, except for the Nyquist frequency of windows with an even size
+        variance = 2 * power.sum(axis=-1, keepdims=True)
+        if window_size % 2 == 0:
+            variance -= power[..., -1:]
+        std = np.sqrt(variance / window_size)
+
+        return np.concatenate((energies, mean, std), axis=-1).reshape(len(windows), -1)
+
+    def get_params(self):
+        return {"num_bands": self.num_bands}
+
+
+"""
+Lightweight classifiers for the ActivityRecognizer with the same interface as the classifiers of sklearn (fit, predict
+and get_params). Predicting only needs a few NumPy operations, which is a lot faster than the SVC with an RBF kernel
+for a single window.
+LinearSvmClassifier minimizes the same objective as the LinearSVC of sklearn (L2 regularization, squared hinge loss,
+one-vs-rest, the bias is regularized like the other weights), with a few Newton steps on the small feature matrix.
+Predicting is a dot product. NearestCentroidClassifier assigns a window to the category whose mean feature vector is
+the nearest.
+"""
+
+
+class LinearSvmClassifier:
+
+    MAX_ITERATIONS = 50  # Newton steps for each category, usually less than ten are needed
+    TOLERANCE = 1e-8  # Training stops if the norm of the gradient is below this value
+
+    def __init__(self, C=1.0):
+        self.C = C  # Regularization parameter of the SVM
+        self.classes_ = None
+        self.weights = None  # Shape (number of features, 1) for two categories, else one column per category
+        self.bias = None
+
+    def fit(self, features, labels):
+        labels = np.asarray(labels)
+        self.classes_ = np.unique(labels)
+        # The bias is the weight of an additional feature that is always 1
+        x = np.column_stack((np.asarray(features, dtype=float), np.ones(len(labels))))
+        positive_classes = self.classes_[1:] if len(self.classes_) == 2 else self.classes_
+        weights = np.column_stack([self.fit_binary(x, np.where(labels == positive_class, 1.0, -1.0))
+                                   for positive_class in positive_classes])
+        self.weights = weights[:-1]
+        self.bias = weights[-1]
+        return self
+
+    # Objective of the SVM for the weights w, the features x and the targets y (1 or -1)
+    def get_objective(self, w, x, y):
+        violations = np.maximum(0, 1 - y * np.dot(x, w))
+        return 0.5 * np.dot(w, w) + self.C * np.dot(violations, violations)
+
+    # Trains the weights that separate the targets 1 from -1. The squared hinge loss is differentiable, so Newton steps
+    # on the samples that violate the margin are used, with a backtracking line search
+    def fit_binary(self, x, y):
+        w = np.zeros(x.shape[1])
+        objective = self.get_objective(w, x, y)
+        for i in range(LinearSvmClassifier.MAX_ITERATIONS):
+            margins = 1 - y * np.dot(x, w)
+            active = margins > 0
+            x_active = x[active]
+            gradient = w - 2 * self.C * np.dot(x_active.T, y[active] * margins[active])
+            if np.linalg.norm(gradient) < LinearSvmClassifier.TOLERANCE:
+                break
+            hessian = np.eye(len(w)) + 2 * self.C * np.dot(x_active.T, x_active)
+            step = np.linalg.solve(hessian, gradient)
+
+            step_size = 1.0
+            while step_size > 1e-10:
+                new_w = w - step_size * step
+                new_objective = self.get_objective(new_w, x, y)
+                if new_objective <= objective - 0.5 * step_size * np.dot(gradient, step):
+                    break
+                step_size /= 2
+            w, objective = new_w, new_objective
+        return w
+
+    def predict(self, features):
+        scores = np.dot(features, self.weights) + self.bias
+        if scores.shape[1] == 1:  # Two categories: positive scores belong to the second one
+            return self.classes_[(scores[:, 0] > 0).astype(int)]
+        return self.classes_[scores.argmax(axis=1)]
+
+    # Parameters of the classifier, they are part of the key of the cached classifier
+    def get_params(self):
+        return {"C": self.C}
+
+
+class NearestCentroidClassifier:
+
+    def __init__(self):
+        self.classes_ = None
+        self.centroids = None  # Mean feature vector of each category
+
+    def fit(self, features, labels):
+        features = np.asarray(features, dtype=float)
+        labels = np.asarray(labels)
+        self.classes_ = np.unique(labels)
+        self.centroids = np.array([features[labels == category].mean(axis=0) for category in self.classes_])
+        return self
+
+    def predict(self, features):
+        differences = np.asarray(features)[:, np.newaxis, :] - self.centroids
+        return self.classes_[np.einsum("ijk,ijk->ij", differences, differences).argmin(axis=1)]
+
+    def get_params(self):
+        return {}
+
+
+# The SVC of sklearn with an RBF kernel. sklearn is imported here, because importing it takes a lot of time
+def create_rbf_svm():
+    from sklearn import svm
+    return svm.SVC()
+
+
 """
 This class is responsible for the activity recognition. It is used for detecting the reload gesture
 (poining the wiimote upwards -> shake the wiimote -> point the wiimote forwards)
@@ -973,50 +2247,125 @@ The code for this class has been taken from the solution for Assignment08 by And
 
 class ActivityRecognizer:
 
-    def __init__(self):
+    CACHE_VERSION = 4  # Has to be increased if the features or the training change, so old caches are not used
+    FEATURES = {"band_energy": BandEnergyFeatures, "mean_spectrum": MeanSpectrumFeatures}
+    CLASSIFIERS = {"rbf_svm": create_rbf_svm, "linear_svm": LinearSvmClassifier,
+                   "nearest_centroid": NearestCentroidClassifier}
+
+    def __init__(self, hop_size=10, cache_file=None, features="band_energy", classifier="rbf_svm"):
+        if features not in ActivityRecognizer.FEATURES:
+            raise ValueError("Unknown features: " + str(features))
+        if classifier not in ActivityRecognizer.CLASSIFIERS:
+            raise ValueError("Unknown classifier: " + str(classifier))
+        self.feature_extractor = ActivityRecognizer.FEATURES[features]()
         self.category_list = []
         self.ready_for_prediction = False
-        self.c = svm.SVC()
-        self.prediction_values = [[], [], []]
+        self.c = self.create_classifier(classifier)
         self.minlen = 1000  # Just a large value to begin with, far larger than the values we can expect
-        self.read_data_from_csv()
+        # The last minlen values are kept in a ring buffer (sliding window). Every hop_size new values, the window
+        # is classified. Consecutive windows overlap, so a reload that started in one window is not missed.
+        self.hop_size = hop_size
+        self.prediction_values = None  # AccelerometerRingBuffer, created after training when minlen is known
+        self.values_since_prediction = 0
+        self.num_calls = 0  # Number of calls of predict_activity
+        self.time_of_calls = 0.0  # Total duration of all calls of predict_activity in seconds
+
+        # The trained classifier and the features are cached on disk and only trained again if a template or the
+        # parameters changed. If cache_file is False, nothing is cached.
+        if cache_file is None:
+            cache_file = path.join(Constants.CACHE_DIR, "activity_model.pickle")
+        self.cache_file = cache_file
+        self.features = None  # Feature matrix the classifier has been trained with
+        self.labels = None  # Category of each row of the feature matrix
+        if not self.load_cached_model():
+            self.read_data_from_csv()
+
+    def create_classifier(self, name):
+        return ActivityRecognizer.CLASSIFIERS[name]()
+
+    # Hash over the contents of all template files and the parameters of the classifier
+    def get_cache_key(self):
+        key = hashlib.sha1()
+        sklearn_version = None
+        if type(self.c).__module__.startswith("sklearn"):  # The pickled classifier depends on the version of sklearn
+            from sklearn import __version__ as sklearn_version
+        parameters = (ActivityRecognizer.CACHE_VERSION, sklearn_version, type(self.c).__name__,
+                      sorted(self.c.get_params().items()), type(self.feature_extractor).__name__,
+                      sorted(self.feature_extractor.get_params().items()))
+        key.update(repr(parameters).encode())
+        for csv_file in sorted(glob.glob(path.join("activity_templates", "*.csv"))):
+            key.update(csv_file.encode())
+            with open(csv_file, "rb") as file:
+                key.update(file.read())
+        return key.hexdigest()
+
+    # Loads the trained classifier from the cache file. Returns False if there is no valid cache for the current
+    # templates and parameters
+    def load_cached_model(self):
+        if not self.cache_file:
+            return False
+        key = self.get_cache_key()
+        # A missing, truncated or otherwise broken cache file can raise nearly any exception while unpickling or
+        # unpacking it. The classifier is trained again in that case
+        try:
+            with open(self.cache_file, "rb") as file:
+                cache = pickle.load(file)
+            if not isinstance(cache, dict) or cache.get("key") != key:
+                return False
+            model = (cache["classifier"], cache["feature_extractor"], int(cache["minlen"]), list(cache["categories"]),
+                     cache["features"], cache["labels"])
+        except Exception:
+            return False
 
-    def get_categories(self):
-        csv_files = glob.glob(path.join("activity_templates", "*.csv"))  # get all csv files from the folder
-        for file in csv_files:
-            # split file at _ character, so that only the name without id is returned
-            category = file.split("/")[1]
-            category = category.split("_")[0]
+        self.c, self.feature_extractor, self.minlen, self.category_list, self.features, self.labels = model
+        self.prepare_prediction()
+        return True
+
+    # Saves the trained classifier and the features. The game still works if the file can not be written
+    def save_cached_model(self):
+        if not self.cache_file:
+            return
+        cache = {
+            "key": self.get_cache_key(),
+            "classifier": self.c,
+            "feature_extractor": self.feature_extractor,
+            "minlen": self.minlen,
+            "categories": self.category_list,
+            "features": self.features,
+            "labels": self.labels
+        }
+        try:
+            if path.dirname(self.cache_file):
+                makedirs(path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, "wb") as file:
+                pickle.dump(cache, file)
+        except OSError:
+            pass
+
+    def get_categories(self, template_names):
+        for name in template_names:
+            # split file name at _ character, so that only the name without id is returned
+            category = name.split("_")[0]
             if category not in self.category_list:
                 self.category_list.append(category)
         return self.category_list
 
     # Parts of the code taken from the "Wiimote - FFT - SVM" notebook from Grips
     def read_data_from_csv(self):
-        activities = {}
-        categories = self.get_categories()
+        template_names, values, offsets = TemplateLoader.load("activity_templates", 3)
+        categories = self.get_categories(template_names)
         if len(categories) == 0:  # No Categories exist. Training not possible
             return
         if len(categories) < 2:  # Not enough categories created to train
             return
 
+        activities = {}
         for category in categories:
             activities[category] = []
 
-        csv_files = glob.glob(path.join("activity_templates", "*.csv"))
-        if len(csv_files) == 0:  # If no CSV Files to train with exist
-            return
-
-        for csv_file in csv_files:
-            category_name = csv_file.split("/")[1]
-            category_name = category_name.split("_")[0]
-            for activity_name, value in activities.items():
-                if activity_name == category_name:
-                    activities[activity_name].append([])
-                    for line in open(csv_file, "r").readlines():
-                        x, y, z = map(int, line.strip().split(","))
-                        mean = (x + y + z) / 3
-                        activities[activity_name][len(activities[activity_name]) - 1].append(mean)
+        for i in range(len(template_names)):
+            category_name = template_names[i].split("_")[0]
+            activities[category_name].append(values[offsets[i]:offsets[i + 1]])
 
         self.cut_off_data(activities)
 
@@ -1034,12 +2383,15 @@ class ActivityRecognizer:
 
         self.convert_to_frequency(activities)
 
+    # The features of all templates are extracted at once from an array with the shape (templates, 3, minlen)
     def convert_to_frequency(self, activities):
+        windows = np.array([np.transpose(l) for value in activities.values() for l in value], dtype=float)
+        features = self.feature_extractor.fit_transform(windows)
 
+        start = 0
         for activity_name, value in activities.items():
-            # This line is taken from the "Wiimote - FFT - SVM" notebook from Grips
-            temp = [np.abs(fft(l) / len(l))[1:len(l) // 2] for l in value]
-            activities[activity_name] = temp
+            activities[activity_name] = list(features[start:start + len(value)])
+            start += len(value)
 
         self.train(activities)
 
@@ -1053,105 +2405,173 @@ class ActivityRecognizer:
                 categories.append(activity_name)
                 training_data.append(value[i])
 
-        self.c.fit(training_data, categories)
+        self.features = np.array(training_data)
+        self.labels = categories
+        self.c.fit(self.features, categories)
+        self.save_cached_model()
+        self.prepare_prediction()
+
+    # Creates the buffer for the accelerometer values, as soon as the classifier has been trained
+    def prepare_prediction(self):
+        self.prediction_values = AccelerometerRingBuffer(self.minlen)
+        self.values_since_prediction = 0
         self.ready_for_prediction = True
 
     # Recognize the acitivity using the values from the wiimote accelerometer
     def predict_activity(self, x, y, z):
 
         if self.ready_for_prediction:
-            if len(self.prediction_values[0]) < self.minlen:  # Buffer enough values for prediction
-                self.prediction_values[0].append(x)
-                self.prediction_values[1].append(y)
-                self.prediction_values[2].append(z)
-                return ""
-            else:
-                avg = []
-                for i in range(len(self.prediction_values[0])):
-                    avg.append((self.prediction_values[0][i] + self.prediction_values[1][i] +
-                                self.prediction_values[2][i]) / 3)
+            start = time.perf_counter()
+            activity = ""
+
+            # The oldest value is overwritten as soon as the window is full
+            self.prediction_values.append(x, y, z)
+            self.values_since_prediction += 1
+
+            # Buffer enough values for prediction and only predict once every hop_size values
+            if self.prediction_values.is_full() and self.values_since_prediction >= self.hop_size:
+                self.values_since_prediction = 0
+                features = self.feature_extractor.transform_window(self.prediction_values.get_window())
+                activity = str(self.c.predict(features)[0])
+
+            self.num_calls += 1
+            self.time_of_calls += time.perf_counter() - start
+            return activity
+
+    # Returns the memory used for buffering the accelerometer values and the mean duration of predict_activity
+    def get_stats(self):
+        memory = 0
+        if self.prediction_values is not None:
+            memory = self.prediction_values.get_memory_footprint()
+        mean_duration = 0.0
+        if self.num_calls > 0:
+            mean_duration = self.time_of_calls / self.num_calls * 1000
+        return {"buffer_memory_bytes": memory, "calls": self.num_calls, "mean_call_ms": mean_duration}
+
+
+"""
+This class is a ring buffer for the accelerometer values of the Wiimote, backed by a preallocated (3, size) NumPy array.
+Adding a value only overwrites the oldest one. The window is passed to the features of the ActivityRecognizer as it is.
+The magnitudes of a DFT do not change if the values are rotated, so the buffer does not need to be reordered.
+"""
+
+
+class AccelerometerRingBuffer:
+
+    def __init__(self, size):
+        self.size = size
+        self.values = np.zeros((3, size))  # x, y and z values
+        self.position = 0  # Index the next value is written to
+        self.count = 0  # Number of values in the buffer
+        self.window = self.values[np.newaxis]  # View with the shape (1, 3, size) the features are extracted from
+
+    def append(self, x, y, z):
+        self.values[0, self.position] = x
+        self.values[1, self.position] = y
+        self.values[2, self.position] = z
+        self.position = (self.position + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
 
-                self.prediction_values = [[], [], []]
+    def is_full(self):
+        return self.count == self.size
 
-                # This line is taken from the "Wiimote - FFT - SVM" notebook from Grips
-                freq = [np.abs(fft(avg) / len(avg))[1:len(avg) // 2]]
-                return str(self.c.predict(freq)[0])
+    # Returns the values in the buffer (not in chronological order). The returned array changes with the next append
+    def get_window(self):
+        return self.window
+
+    # Memory used by the buffer in bytes
+    def get_memory_footprint(self):
+        return self.values.nbytes
 
 
 """
 This class implements the $1 gesture recognizer from the paper: Wobbrock, J.O., Wilson, A.D. and Li, Y. (2007).
 Gestures without libraries, toolkits or training: A $1 recognizer for user interface prototypes.
 The code has been taken from the solution of Assignment09 from Andrea Fischer and Miriam Schlindwein
+Besides the original implementation ("dollar_one"), the templates can be matched with a vectorized implementation
+("vectorized") that stores all templates in one NumPy array and runs the golden section search for all templates
+at once. Both return the same results.
+The third method ("protractor") calculates the best rotation angle for each template in closed form, like the Protractor
+recognizer from Li, Y. (2010). Protractor: a fast and accurate gesture recognizer. The path distance is then only
+calculated once per template at that angle, so the result can be compared with the same threshold as $1.
 """
 
 
 class GestureRecognizer:
 
-    def __init__(self):
+    METHODS = ["dollar_one", "vectorized", "protractor"]  # Available implementations for matching the templates
+
+    def __init__(self, method="vectorized"):
+        if method not in GestureRecognizer.METHODS:
+            raise ValueError("Unknown recognition method: " + str(method))
+        self.method = method
         self.gestures = []
         self.names = []
         self.N = 64
         self.size = 100
         self.origin = 100, 100
         self.ratio = 1/2 * (-1 + np.sqrt(5))
+        self.threshold = 15  # A drawing is recognized if its distance to a template is below this value
         self.load_templates()
+        self.build_index()
+
+    # All templates are put in one array with the shape (number of templates, N, 2) and the index is built
+    def build_index(self):
+        self.templates = np.array(self.gestures, dtype=float).reshape(len(self.gestures), self.N, 2)
+        self.index = TemplateIndex(self.templates, self.size)
+
+    # Adds a template (N points that have already been normalized) and rebuilds the index
+    def add_template(self, name, template):
+        self.names.append(name)
+        self.gestures.append(template)
+        self.build_index()
 
     # get all templates that are stored as data values within csv files
     def load_templates(self):
-        csv_files = glob.glob(path.join("drawing_templates", "*.csv"))  # get all csv files from the directory
+        template_names, points, offsets = TemplateLoader.load("drawing_templates", 2)
 
-        for file in csv_files:
-            # split file at ".", so that only the name without ".csv" is returned
-            filename = file.split(".")[0]
-            self.names.append(filename)
-            template = []
-
-            with open(file) as csvfile:
-                readcsv = csv.reader(csvfile, delimiter=',')
-                for row in readcsv:
-                    # get content of csv and store it in template list
-                    template.append([float(row[0]), float(row[1])])
-            self.gestures.append(template)
+        for i in range(len(template_names)):
+            self.names.append(path.join("drawing_templates", template_names[i]))
+            self.gestures.append(points[offsets[i]:offsets[i + 1]])
 
     # Try to recognize the drawing using the passed coordinates
     def recognize_drawing(self, drawing_x_coordinates, drawing_y_coordinates):
         if len(drawing_x_coordinates) < 4:  # Skip recognition if not enough points are drawn (so no error shows)
             return
 
-        points = []
+        points = np.column_stack((drawing_x_coordinates, drawing_y_coordinates))
+        points_for_recognition = self.preprocess(points)
+        recgonize = self.recognize(points_for_recognition)
 
-        for i in range(len(drawing_x_coordinates)):
-            points.append([drawing_x_coordinates[i], drawing_y_coordinates[i]])
+        return recgonize
 
-        resampled_points = self.resample(points)
+    def preprocess(self, points):
+        """the drawn points are resampled, rotated, scaled and translated, so they can be compared to the templates"""
+        return self.normalize(self.resample(points))
+
+    def normalize(self, resampled_points):
+        """the resampled points are rotated, scaled and translated"""
         rotated_points = self.rotate(resampled_points)
         scaled_points = self.scale(rotated_points)
-        points_for_recognition = self.translate(scaled_points)
-        recgonize = self.recognize(points_for_recognition)
+        return self.translate(scaled_points)
 
-        return recgonize
+    def get_shape_name(self, index):
+        """returns the name of the shape of a template, e.g. "square" for drawing_templates/square_clock.csv"""
+        return path.basename(self.names[index]).split("_")[0]
 
     def resample(self, gesture):
-        """the input gestures are sampled to the length n and the list newPoints is returned"""
-        newPoints = [gesture[0]]
-        distance = 0.0
-        path = self.pathLength(gesture)
-        pathLen = path / (self.N - 1)
-        i = 1
-        while i < len(gesture):
-            d = self.Distance(gesture[i-1], gesture[i])
-            if distance + d >= pathLen:
-                x = gesture[i-1][0] + ((pathLen - distance)/d) * (gesture[i][0] - gesture[i-1][0])
-                y = gesture[i-1][1] + ((pathLen - distance)/d) * (gesture[i][1] - gesture[i-1][1])
-                q = (x, y)
-                newPoints.append(q)
-                gesture.insert(i, q)
-                distance = 0.0
-            else:
-                distance += d
-            i += 1
-        if len(newPoints) == self.N - 1:
-            newPoints.append(gesture[len(gesture)-1])
+        """the input gesture is resampled to N points that are equally spaced along its path and the list newPoints
+        is returned. The points are interpolated using the cumulative path length, so this takes linear time and the
+        passed gesture is not changed"""
+        points = np.asarray(gesture, dtype=float)
+        segment_lengths = np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1))
+        cumulative_length = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+        positions = np.linspace(0.0, cumulative_length[-1], self.N)
+
+        x = np.interp(positions, cumulative_length, points[:, 0])
+        y = np.interp(positions, cumulative_length, points[:, 1])
+        newPoints = np.column_stack((x, y)).tolist()
         return newPoints
 
     def Distance(self, p1, p2):
@@ -1200,13 +2620,14 @@ class GestureRecognizer:
         return newPoints
 
     def scale(self, gesture):
-        """the gesture is scaled to a defined size and the calculated newPoints are returned"""
-        self.boundingBox = self.getBoundingBox(gesture)
+        """the gesture is scaled to a defined size and the calculated newPoints are returned. The bounding box is
+        kept in a local variable, because the RecognitionWorker uses the recognizer from another thread"""
+        boundingBox = self.getBoundingBox(gesture)
         newPoints = []
         for i in range(len(gesture)):
 
-            x = gesture[i][0] * (self.size / (self.boundingBox[1][0] - self.boundingBox[0][0]))
-            y = gesture[i][1] * (self.size / (self.boundingBox[1][1] - self.boundingBox[0][1]))
+            x = gesture[i][0] * (self.size / (boundingBox[1][0] - boundingBox[0][0]))
+            y = gesture[i][1] * (self.size / (boundingBox[1][1] - boundingBox[0][1]))
 
             newPoints.append([float(x), float(y)])
 
@@ -1231,20 +2652,28 @@ class GestureRecognizer:
         return newPoints
 
     def recognize(self, points):
-        """calculates the distance between points and templates and returns the number of template
+        """calculates the distance between points and templates and returns True if the drawing has been recognized,
         if there is no recognition False is returned"""
-        b = np.inf
+        return self.get_best_match(points)[0] < self.threshold
+
+    def get_best_match(self, points):
+        """returns the smallest distance between the points and a template and the index of that template.
+        Only the templates that have not been pruned by the index are compared"""
+        candidates = self.index.get_candidates(points)
+        if len(candidates) == 0:
+            return np.inf, None
         angle = 45
         a = 2
-        for i in range(len(self.gestures)):
-            template = self.gestures[i]
-            d = self.distanceAtBestAngle(points, template, - angle, angle, a)
-            if d < b:
-                b = d
-        if b < 15:
-            return True
+        if self.method == "vectorized":
+            distances = self.distancesAtBestAngle(np.asarray(points, dtype=float), - angle, angle, a,
+                                                  self.templates[candidates])
+        elif self.method == "protractor":
+            distances = self.distancesAtOptimalAngle(np.asarray(points, dtype=float), self.templates[candidates],
+                                                     self.index.vectors[candidates])
         else:
-            return False
+            distances = [self.distanceAtBestAngle(points, self.gestures[i], - angle, angle, a) for i in candidates]
+        best = int(np.argmin(distances))
+        return float(distances[best]), int(candidates[best])
 
     def distanceAtBestAngle(self, points, T, minAngle, angle, a):
         """the minimum distance in dependence on the angle is calculated"""
@@ -1282,6 +2711,332 @@ class GestureRecognizer:
             d += self.Distance(A[i], B[i])
         return d/len(A)
 
+    def distancesAtBestAngle(self, points, minAngle, angle, a, templates=None):
+        """golden section search like in distanceAtBestAngle, but for all templates (or the passed ones) at once.
+        Every template has its own search interval, the intervals of all templates shrink by the same factor in
+        each step"""
+        if templates is None:
+            templates = self.templates
+        # the points are rotated around their centroid, so it is moved to the origin once for the whole search
+        centroid = np.mean(points, 0)
+        centered = points - centroid
+        templates = templates - centroid
+
+        num_templates = len(templates)
+        minAngles = np.full(num_templates, float(minAngle))
+        angles = np.full(num_templates, float(angle))
+
+        x1 = self.ratio * minAngles + (1 - self.ratio) * angles
+        f1 = self.distancesAtAngles(centered, templates, x1)
+        x2 = (1 - self.ratio) * minAngles + self.ratio * angles
+        f2 = self.distancesAtAngles(centered, templates, x2)
+
+        while np.max(np.abs(angles - minAngles)) > a:
+            smaller = f1 < f2
+            # if f1 < f2 the upper bound moves to x2, otherwise the lower bound moves to x1
+            angles = np.where(smaller, x2, angles)
+            minAngles = np.where(smaller, minAngles, x1)
+            new_x1 = np.where(smaller, self.ratio * minAngles + (1 - self.ratio) * angles, x2)
+            new_x2 = np.where(smaller, x1, (1 - self.ratio) * minAngles + self.ratio * angles)
+
+            # only one new distance per template needs to be calculated
+            f = self.distancesAtAngles(centered, templates, np.where(smaller, new_x1, new_x2))
+            f1, f2 = np.where(smaller, f, f2), np.where(smaller, f1, f)
+            x1, x2 = new_x1, new_x2
+
+        return np.minimum(f1, f2)
+
+    def distancesAtOptimalAngle(self, points, templates, vectors):
+        """the angle at which the points fit each template best is calculated in closed form (Protractor), with one
+        dot product pass over the precomputed template vectors. The path distance at that angle is returned, so it can
+        be compared with the results of the golden section search"""
+        centroid = np.mean(points, 0)
+        centered = points - centroid
+        a = np.sum(vectors * centered, axis=(1, 2))
+        b = np.sum(vectors[:, :, 1] * centered[:, 0] - vectors[:, :, 0] * centered[:, 1], axis=1)
+        optimal_angles = np.arctan2(b, a)
+        # distancesAtAngles rotates by the negative angle, like rotateBy
+        return self.distancesAtAngles(centered, templates - centroid, -optimal_angles)
+
+    def distancesAtAngles(self, centered, templates, angles):
+        """the points (N x 2 array, centroid at the origin) are rotated by one angle per template and the path
+        distance to that template (moved by the same offset as the points) is returned for each template"""
+        cos = np.cos(-angles)[:, np.newaxis]
+        sin = np.sin(-angles)[:, np.newaxis]
+        dx = centered[:, 0] * cos - centered[:, 1] * sin - templates[:, :, 0]
+        dy = centered[:, 0] * sin + centered[:, 1] * cos - templates[:, :, 1]
+        return np.mean(np.sqrt(dx * dx + dy * dy), axis=1)
+
+
+"""
+This class is an index over the templates of the GestureRecognizer. When it is built, the normalized vectors of all
+templates are precomputed: Protractor-style vectors (centered at the origin and scaled to unit length) and a few cheap
+shape features (path length and how closed the shape is). Before the expensive golden section search, the index uses
+them to prune the templates that can not match the drawing, so the recognition time does not grow with the number
+of templates. Protractor: Li, Y. (2010). Protractor: a fast and accurate gesture recognizer.
+"""
+
+
+class TemplateIndex:
+
+    MAX_CANDIDATES = 4  # Max number of templates that are compared with the full search
+    MAX_CLOSEDNESS_DIFFERENCE = 0.3  # Max difference of the closedness of the drawing and a template
+    MAX_PATH_LENGTH_RATIO = 1.5  # Max ratio between the path length of the drawing and the one of a template
+
+    def __init__(self, templates, size):
+        self.size = size  # Size of the normalized templates
+        self.vectors = self.get_vectors(templates)  # Protractor vectors with the shape (number of templates, N, 2)
+        self.closedness, self.path_length = self.get_features(templates)
+
+    @staticmethod
+    def get_vectors(points):
+        """points with the shape (..., N, 2) are moved to the origin and scaled to unit length"""
+        centered = points - np.mean(points, axis=-2, keepdims=True)
+        length = np.sqrt(np.sum(centered ** 2, axis=(-2, -1), keepdims=True))
+        return centered / np.where(length == 0, 1, length)
+
+    def get_features(self, points):
+        """returns how closed each shape is (distance from the first to the last point relative to the path length)
+        and its path length relative to the size of the normalized templates"""
+        path_length = np.sum(np.sqrt(np.sum(np.diff(points, axis=-2) ** 2, axis=-1)), axis=-1)
+        gap = np.sqrt(np.sum((points[..., -1, :] - points[..., 0, :]) ** 2, axis=-1))
+        return gap / np.where(path_length == 0, 1, path_length), path_length / self.size
+
+    def get_similarities(self, points):
+        """cosine similarity between the drawing and every template at the optimal rotation angle (closed form
+        of Protractor), one dot product pass over all templates"""
+        vector = self.get_vectors(np.asarray(points, dtype=float))
+        a = np.sum(self.vectors * vector, axis=(1, 2))
+        b = np.sum(self.vectors[:, :, 0] * vector[:, 1] - self.vectors[:, :, 1] * vector[:, 0], axis=1)
+        return np.sqrt(a * a + b * b)
+
+    def get_candidates(self, points):
+        """returns the indices of the templates that need to be compared with the full search"""
+        num_templates = len(self.vectors)
+        if num_templates <= TemplateIndex.MAX_CANDIDATES:
+            return np.arange(num_templates)
+
+        closedness, path_length = self.get_features(np.asarray(points, dtype=float))
+        possible = (np.abs(self.closedness - closedness) <= TemplateIndex.MAX_CLOSEDNESS_DIFFERENCE) & \
+                   (np.maximum(self.path_length, path_length) <=
+                    TemplateIndex.MAX_PATH_LENGTH_RATIO * np.minimum(self.path_length, path_length))
+        candidates = np.nonzero(possible)[0]
+
+        # Only keep the templates that are the most similar to the drawing
+        if len(candidates) > TemplateIndex.MAX_CANDIDATES:
+            similarities = self.get_similarities(points)[candidates]
+            candidates = candidates[np.argsort(-similarities)[:TemplateIndex.MAX_CANDIDATES]]
+        return candidates
+
+
+"""
+This class collects the points of a drawing while the A button is held. The path length, the centroid and the bounding
+box are updated with every new point, so they are available at any time without going through all points again.
+While drawing, provisional matches are calculated by the RecognitionWorker (e.g. to give live feedback to the player)
+and the latest one is kept here. When the A button is
+released, the resampling uses the running path length. The rotation, scaling and the template comparison depend on the
+resampled points of the whole drawing, so they are only skipped if no point has been added since the last match.
+"""
+
+
+class IncrementalGesture:
+
+    PROVISIONAL_INTERVAL = 5  # Number of new points before the provisional match is calculated again
+
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.reset()
+
+    # Removes all points, e.g. after the drawing has been recognized
+    def reset(self):
+        self.x_values = []
+        self.y_values = []
+        self.cumulative_length = []  # Length of the path from the first point to each point
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.min_x = self.min_y = np.inf
+        self.max_x = self.max_y = -np.inf
+        self.provisional_match = None  # (distance, index of the template) of the last calculated match
+        self.provisional_num_points = 0  # Number of points the last match has been calculated for
+
+    def add_point(self, x, y):
+        if len(self.x_values) == 0:
+            self.cumulative_length.append(0.0)
+        else:
+            dx = x - self.x_values[-1]
+            dy = y - self.y_values[-1]
+            self.cumulative_length.append(self.cumulative_length[-1] + math.sqrt(dx*dx + dy*dy))
+
+        self.x_values.append(x)
+        self.y_values.append(y)
+        self.sum_x += x
+        self.sum_y += y
+        self.min_x = min(self.min_x, x)
+        self.max_x = max(self.max_x, x)
+        self.min_y = min(self.min_y, y)
+        self.max_y = max(self.max_y, y)
+
+    def __len__(self):
+        return len(self.x_values)
+
+    def get_path_length(self):
+        if len(self.cumulative_length) == 0:
+            return 0.0
+        return self.cumulative_length[-1]
+
+    def get_centroid(self):
+        return self.sum_x / len(self.x_values), self.sum_y / len(self.y_values)
+
+    # Same format as GestureRecognizer.getBoundingBox
+    def get_bounding_box(self):
+        return (self.min_x, self.min_y), (self.max_x, self.max_y)
+
+    # Resamples the points to N points using the running path length (same result as GestureRecognizer.resample)
+    def resample(self):
+        positions = np.linspace(0.0, self.get_path_length(), self.recognizer.N)
+        x = np.interp(positions, self.cumulative_length, self.x_values)
+        y = np.interp(positions, self.cumulative_length, self.y_values)
+        return np.column_stack((x, y)).tolist()
+
+    # Compares the points collected so far with the templates. Returns the distance and index of the best template
+    def match(self):
+        self.provisional_match = self.recognizer.get_best_match(self.recognizer.normalize(self.resample()))
+        self.provisional_num_points = len(self.x_values)
+        return self.provisional_match
+
+    # True if enough new points have been added since the last provisional match to calculate it again
+    def needs_provisional_match(self):
+        if len(self.x_values) < 4:
+            return False
+        return self.provisional_match is None or \
+            len(self.x_values) - self.provisional_num_points >= IncrementalGesture.PROVISIONAL_INTERVAL
+
+    # Stores a provisional match (distance, index of the template) that has been calculated for the first num_points
+    def set_provisional_match(self, match, num_points):
+        self.provisional_match = match
+        self.provisional_num_points = num_points
+
+    # Returns the name of the shape the drawing looked like at the latest provisional match or None. Nothing is
+    # calculated here
+    def get_provisional_match(self):
+        if self.provisional_match is None:
+            return None
+
+        distance, index = self.provisional_match
+        if distance < self.recognizer.threshold:
+            return self.recognizer.get_shape_name(index)
+        return None
+
+    # Final recognition after the A button has been released (same result as GestureRecognizer.recognize_drawing)
+    def recognize(self):
+        if len(self.x_values) < 4:  # Skip recognition if not enough points are drawn
+            return
+        if self.provisional_match is not None and self.provisional_num_points == len(self.x_values):
+            distance = self.provisional_match[0]  # Nothing has been drawn since the last match
+        else:
+            distance = self.match()[0]
+        return distance < self.recognizer.threshold
+
+
+"""
+This class runs the gesture recognition of a finished drawing in a background thread, so the game loop never waits
+for the classifier. A drawing is submitted when the A button is released and the result is picked up in one of the
+next frames. While the player is drawing, the provisional matches run in the same thread, one at a time: the points
+are resampled by the game loop and only the normalization and the template matching run in the background. The times
+the recognitions took are measured separately from the frame time.
+"""
+
+
+class RecognitionWorker:
+
+    NUM_LATENCIES = 100  # Number of recognition durations that are kept for the statistics
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None  # The recognition that is currently running or whose result has not been picked up yet
+        self.latencies = deque(maxlen=RecognitionWorker.NUM_LATENCIES)  # Durations of the recognitions in ms
+        self.provisional = None  # (future, gesture, number of points) of the provisional match that is running
+        self.provisional_latencies = deque(maxlen=RecognitionWorker.NUM_LATENCIES)  # Durations in ms
+
+    # Starts the recognition of a finished drawing (IncrementalGesture). The gesture must not be changed afterwards
+    def submit(self, gesture):
+        self.cancel()
+        self.future = self.executor.submit(self.recognize, gesture)
+
+    # Called every frame while the player is drawing. Passes a finished provisional match to the gesture and starts
+    # the next one, if the gesture needs one and no other provisional match is running
+    def update_provisional(self, gesture):
+        if self.provisional is not None:
+            future, provisional_gesture, num_points = self.provisional
+            if not future.done():
+                return
+            self.provisional = None
+            try:
+                match, latency = future.result()
+            except Exception:  # The provisional match is only a hint, so it is skipped
+                match = None
+            else:
+                self.provisional_latencies.append(latency)
+            if match is not None and provisional_gesture is gesture:
+                gesture.set_provisional_match(match, num_points)
+
+        if gesture.needs_provisional_match():
+            points = gesture.resample()  # A copy, the gesture gets new points while the match is running
+            future = self.executor.submit(self.match_provisional, gesture.recognizer, points)
+            self.provisional = (future, gesture, len(gesture))
+
+    # Runs in the background thread
+    def match_provisional(self, recognizer, points):
+        start = time.perf_counter()
+        match = recognizer.get_best_match(recognizer.normalize(points))
+        return match, (time.perf_counter() - start) * 1000
+
+    # Runs in the background thread
+    def recognize(self, gesture):
+        start = time.perf_counter()
+        result = gesture.recognize()
+        return result, (time.perf_counter() - start) * 1000
+
+    # The result of the current recognition is not needed anymore (e.g. because a new drawing has been started)
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        if self.provisional is not None:
+            self.provisional[0].cancel()
+            self.provisional = None
+
+    # Stops the background thread. A recognition that has not been started yet is dropped
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(cancel_futures=True)
+
+    # Returns (True, result) if a recognition has finished since the last call, otherwise (False, None).
+    # Never waits for the recognition. If the recognition failed, the drawing is treated as not recognized
+    def get_result(self):
+        if self.future is None or not self.future.done():
+            return False, None
+
+        try:
+            result, latency = self.future.result()
+        except Exception:
+            self.future = None
+            return True, False
+        self.future = None
+        self.latencies.append(latency)
+        return True, result
+
+    # Returns the median and max duration of the last recognitions and provisional matches in ms
+    def get_stats(self):
+        stats = {}
+        for name, latencies in [("recognitions", self.latencies), ("provisional", self.provisional_latencies)]:
+            if len(latencies) == 0:
+                stats[name] = {"count": 0, "median_ms": 0.0, "max_ms": 0.0}
+            else:
+                stats[name] = {"count": len(latencies), "median_ms": float(np.median(latencies)),
+                               "max_ms": float(np.max(latencies))}
+        return stats
+
 
 """
 This class gets the coordinates of four LEDs as input params and calculates the coordinates of point the player
@@ -1291,9 +3046,53 @@ is pointing at.
 
 class Pointing:
 
-    # Code taken from the Jupyter Notebook "Projective Transformations" from GRIPS
+    MIN_HOMOGENEOUS_Z = 1e-9  # If the homogeneous z of the mapped point is closer to 0, the point is at infinity
+
+    # The mapping from the unit square to the screen (step 3 of the notebook) never changes, so it is only
+    # calculated once
+    def __init__(self, width=None, height=None):
+        if width is None:
+            width = Constants.WIDTH
+        if height is None:
+            height = Constants.HEIGHT
+
+        # Step 3
+        A2 = 0, height
+        B2 = 0, 0
+        C2 = width, 0
+        D2 = width, height
+
+        dest_points_123 = np.array([[A2[0], B2[0], C2[0]], [A2[1], B2[1], C2[1]], [1, 1, 1]], dtype=float)
+        dest_point_4 = np.array([D2[0], D2[1], 1], dtype=float)
+
+        l, m, t = np.linalg.solve(dest_points_123, dest_point_4)
+        unit_to_dest = np.array([[l * A2[0], m * B2[0], t * C2[0]], [l * A2[1], m * B2[1], t * C2[1]], [l, m, t]])
+        self.unit_to_dest = unit_to_dest.tolist()  # Plain floats are faster than NumPy for single 3x3 products
+
+        self.num_calls = 0  # Number of calls of process_ir_data
+        self.time_of_calls = 0.0  # Total duration of all calls of process_ir_data in seconds
+        self.num_skipped = 0  # Number of samples with LEDs that do not allow a projection
+
+    # Twice the signed area of the triangle pqr, which is the determinant of the matrix with the homogeneous
+    # coordinates of the three points as columns
+    @staticmethod
+    def area(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    # Returns the point on the screen the Wiimote is pointing at or None, if the positions of the LEDs do not allow a
+    # projection (e.g. three of them are on a line). The duration of every call is measured, because this is called
+    # for every IR sample of the Wiimote
     def process_ir_data(self, led_one, led_two, led_three, led_four):
+        start = time.perf_counter()
+        point = self.map_to_screen(led_one, led_two, led_three, led_four)
+        if point is None:
+            self.num_skipped += 1
+        self.num_calls += 1
+        self.time_of_calls += time.perf_counter() - start
+        return point
 
+    # Code taken from the Jupyter Notebook "Projective Transformations" from GRIPS
+    def map_to_screen(self, led_one, led_two, led_three, led_four):
         A = led_one
         B = led_two
         C = led_three
@@ -1318,50 +3117,34 @@ class Pointing:
             D = points[3]
             C = points[2]
 
-        # Step 1
-        source_points_123 = np.matrix([[A[0], B[0], C[0]], [A[1], B[1], C[1]], [1, 1, 1]])
-        source_point_4 = [[D[0]], [D[1]], [1]]
-
-        scale_to_source = np.linalg.solve(source_points_123, source_point_4)
-        l, m, t = [float(x) for x in scale_to_source]
-
-        # Step 2
-        unit_to_source = np.matrix([[l * A[0], m * B[0], t * C[0]], [l * A[1], m * B[1], t * C[1]], [l, m, t]])
-
-        # Step 3
-        A2 = 0, Constants.HEIGHT
-        B2 = 0, 0
-        C2 = Constants.WIDTH, 0
-        D2 = Constants.WIDTH, Constants.HEIGHT
-
-        dest_points_123 = np.matrix([[A2[0], B2[0], C2[0]], [A2[1], B2[1], C2[1]], [1, 1, 1]])
-
-        dest_point_4 = np.matrix([[D2[0]], [D2[1]], [1]])
-
-        scale_to_dest = np.linalg.solve(dest_points_123, dest_point_4)
-        l, m, t = [float(x) for x in scale_to_dest]
-
-        unit_to_dest = np.matrix([[l * A2[0], m * B2[0], t * C2[0]], [l * A2[1], m * B2[1], t * C2[1]],  [l, m, t]])
-
-        # Step 4: Invert  A  to obtain  A−1
-        try:
-            source_to_unit = np.linalg.inv(unit_to_source)
-        except np.linalg.linalg.LinAlgError:
-            return 0, 0
-
-        # Step 5: Compute the combined matrix
-        source_to_dest = unit_to_dest @ source_to_unit
-
-        # Step 6: To map a location  (x,y)  from the source image to its corresponding location in the destination
-        # image, compute the product
-        x, y, z = [float(w) for w in (source_to_dest @ np.matrix([[512], [384], [1]]))]
-
-        # step 7: dehomogenization
+        # Steps 1, 2, 4 and 6 in closed form: the point P the Wiimote is pointing at is mapped to the unit square by
+        # inverse(unit_to_source) @ P. The inverse of the matrix [A B C] is made of the cross products of its
+        # columns, so its product with P and D are the areas of the triangles where P or D replace one of the points.
+        # unit_to_source is [A B C] scaled with the solution for D, so the determinants cancel out.
+        P = Constants.WIIMOTE_IR_CAM_CENTER
+        area_D = self.area(D, B, C), self.area(A, D, C), self.area(A, B, D)
+        if area_D[0] == 0 or area_D[1] == 0 or area_D[2] == 0:  # The LEDs are on a line, no projection possible
+            return None
+        unit = self.area(P, B, C) / area_D[0], self.area(A, P, C) / area_D[1], self.area(A, B, P) / area_D[2]
+
+        # Step 5 and 6: map the point from the unit square to the screen
+        x, y, z = [row[0] * unit[0] + row[1] * unit[1] + row[2] * unit[2] for row in self.unit_to_dest]
+
+        # step 7: dehomogenization. The point is at infinity if the quad of the LEDs is degenerate
+        if abs(z) < Pointing.MIN_HOMOGENEOUS_Z:
+            return None
         x = int(x / z)
         y = int(y / z)
 
         return x, y
 
+    # Returns the number of processed and skipped IR samples and the mean duration of process_ir_data
+    def get_stats(self):
+        mean_duration = 0.0
+        if self.num_calls > 0:
+            mean_duration = self.time_of_calls / self.num_calls * 1000
+        return {"calls": self.num_calls, "skipped": self.num_skipped, "mean_call_ms": mean_duration}
+
 
 """
 This class gets the coordinates of the two LEDs of the head tracking device as input and calculates the position of